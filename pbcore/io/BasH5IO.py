@@ -44,7 +44,7 @@ from pbcore.io.FofnIO import readFofn
 from pbcore.chemistry import (decodeTriple,
                               tripleFromMetadataXML,
                               ChemistryLookupError)
-from ._utils import arrayFromDataset, CommonEqualityMixin
+from ._utils import arrayFromDataset, H5FileMap, CommonEqualityMixin
 
 
 def intersectRanges(r1, r2):
@@ -361,6 +361,9 @@ class ZmwRead(CommonEqualityMixin):
     def _getBasecallsGroup(self):
         return self.baxH5._basecallsGroup
 
+    def _getBasecallsDatasets(self):
+        return self.baxH5._basecallsDatasets
+
     def _getOffsets(self):
         return self.baxH5._offsetsByHole
 
@@ -382,12 +385,13 @@ class ZmwRead(CommonEqualityMixin):
         return self.readEnd - self.readStart
 
     def basecalls(self):
-        return arrayFromDataset(self._getBasecallsGroup()["Basecall"],
+        return arrayFromDataset(self._getBasecallsDatasets()["Basecall"],
                                 self.offsetBegin, self.offsetEnd).tostring()
 
     def qv(self, qvName):
-        return arrayFromDataset(self._getBasecallsGroup()[qvName],
-                                self.offsetBegin, self.offsetEnd)
+        # A copy, as the dataset may be a view of the file map
+        return np.array(arrayFromDataset(self._getBasecallsDatasets()[qvName],
+                                         self.offsetBegin, self.offsetEnd))
 
     PreBaseFrames  = _makeQvAccessor("PreBaseFrames")
     IPD            = _makeQvAccessor("PreBaseFrames")
@@ -412,6 +416,9 @@ class CCSZmwRead(ZmwRead):
     def _getBasecallsGroup(self):
         return self.baxH5._ccsBasecallsGroup
 
+    def _getBasecallsDatasets(self):
+        return self.baxH5._ccsBasecallsDatasets
+
     def _getOffsets(self):
         return self.baxH5._ccsOffsetsByHole
 
@@ -441,6 +448,11 @@ class BaxH5Reader(object):
     """
     The `BaxH5Reader` class provides access to bax.h5 file and
     single-part bas.h5 files.
+
+    Basecall and QV datasets that are stored contiguously and
+    uncompressed are memory mapped when the file is opened, so that
+    `ZmwRead` data is served as views of the map rather than read
+    through HDF5.
     """
     def __init__(self, filename, regionH5Filename=None):
         try:
@@ -448,6 +460,7 @@ class BaxH5Reader(object):
             self.file = h5py.File(self.filename, "r")
         except IOError:
             raise IOError, ("Invalid or nonexistent bax/bas file %s" % filename)
+        self._fileMap = H5FileMap(self.file)
 
         #
         # Raw base calls?
@@ -455,6 +468,7 @@ class BaxH5Reader(object):
         if "/PulseData/BaseCalls/Basecall" in self.file:
             self._basecallsGroup = self.file["/PulseData/BaseCalls"]
             self._offsetsByHole  = _makeOffsetsDataStructure(self._basecallsGroup)
+            self._basecallsDatasets = self._fileMap.datasets(self._basecallsGroup)
             self.hasRawBasecalls = True
         else:
             self.hasRawBasecalls = False
@@ -464,6 +478,7 @@ class BaxH5Reader(object):
         if "/PulseData/ConsensusBaseCalls" in self.file:
             self._ccsBasecallsGroup = self.file["/PulseData/ConsensusBaseCalls"]
             self._ccsOffsetsByHole  = _makeOffsetsDataStructure(self._ccsBasecallsGroup)
+            self._ccsBasecallsDatasets = self._fileMap.datasets(self._ccsBasecallsGroup)
             self._ccsNumPasses      = self._ccsBasecallsGroup["Passes/NumPasses"]
             self.hasConsensusBasecalls = True
         else:
@@ -692,6 +707,9 @@ class BaxH5Reader(object):
         if hasattr(self, "file") and self.file is not None:
             self.file.close()
             self.file = None
+            self._basecallsDatasets = {}
+            self._ccsBasecallsDatasets = {}
+            self._fileMap.close()
 
     def __enter__(self):
         return self
@@ -30,13 +30,19 @@
 
 from __future__ import absolute_import
 import h5py, numpy as np
+from collections import OrderedDict
 from cStringIO import StringIO
 
 
 def arrayFromDataset(ds, offsetBegin, offsetEnd):
     """
-    Extract a one-dimensional array from an HDF5 dataset.
+    Extract a one-dimensional array from an HDF5 dataset.  `ds` may
+    also be a memory mapped view of the dataset (see `H5FileMap`), in
+    which case the slice is returned as a read-only view, without
+    copying.
     """
+    if isinstance(ds, np.ndarray):
+        return ds[offsetBegin:offsetEnd]
     shape = (offsetEnd - offsetBegin,)
     a = np.ndarray(shape=shape, dtype=ds.dtype)
     mspace = h5py.h5s.create_simple(shape)
@@ -46,6 +52,228 @@ def arrayFromDataset(ds, offsetBegin, offsetEnd):
     return a
 
 
+class H5FileMap(object):
+    """
+    A read-only memory map of a whole HDF5 file, from which the
+    datasets stored contiguously (hence unfiltered) are served as
+    views; slices of them then come from the OS page cache, bypassing
+    the HDF5 read path.  The file is mapped once, on first use, so
+    all of its datasets share one mapping.
+    """
+    def __init__(self, h5File):
+        self.h5File = h5File
+        self._map = None
+
+    def dataset(self, ds):
+        """
+        Return a read-only view of the map covering the dataset `ds`
+        of the file, if it can be mapped; otherwise return None.
+        """
+        if (ds.chunks is not None or
+            ds.dtype.hasobject or
+            ds.size == 0 or
+            self.h5File.driver != "sec2"):
+            return None
+        offset = ds.id.get_offset()
+        if offset is None:
+            return None
+        if self._map is None:
+            self._map = np.memmap(self.h5File.filename, mode="r", dtype=np.uint8)
+        nbytes = ds.size * ds.dtype.itemsize
+        return self._map[offset:offset+nbytes].view(ds.dtype).reshape(ds.shape)
+
+    def datasets(self, group):
+        """
+        Return a dict of { dataset_name -> dataset } for the datasets
+        in the HDF5 `group`, where the datasets that can be mapped are
+        replaced by their views.
+        """
+        datasets = {}
+        for (name, ds) in group.items():
+            if isinstance(ds, h5py.Dataset):
+                mapped = self.dataset(ds)
+                datasets[name] = mapped if mapped is not None else ds
+        return datasets
+
+    def close(self):
+        # The mapping itself goes away with the last view of it
+        self._map = None
+
+
+def concatenatedRanges(begins, ends):
+    """
+    Return the concatenation of the integer ranges [begins[i], ends[i])
+    as a single array, computed without a Python-level loop.
+    """
+    begins = np.asarray(begins, dtype=np.int64)
+    ends   = np.asarray(ends,   dtype=np.int64)
+    lengths = ends - begins
+    # Each output element is the begin of its range plus its rank
+    # within the range
+    outputStarts = np.cumsum(lengths) - lengths
+    return np.arange(lengths.sum()) - np.repeat(outputStarts - begins, lengths)
+
+
+def reversedSegmentsIndex(offsets, reverse):
+    """
+    Given CSR `offsets` delimiting segments of a flat array, return an
+    index array that reverses, in place, those segments `i` for which
+    `reverse[i]` is true, leaving the others untouched.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    ix = np.arange(offsets[-1])
+    flip = np.repeat(np.asarray(reverse, dtype=bool), lengths)
+    mirror = np.repeat(offsets[:-1] + offsets[1:] - 1, lengths)
+    ix[flip] = mirror[flip] - ix[flip]
+    return ix
+
+
+def segmentedExclusiveCumsum(values, offsets):
+    """
+    For a flat array of `values` divided into CSR segments by
+    `offsets`, return the exclusive cumulative sum of the values
+    within each segment.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    cumulative = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum(values, out=cumulative[1:])
+    return cumulative[:-1] - np.repeat(cumulative[offsets[:-1]], np.diff(offsets))
+
+
+def compressedSegments(data, offsets, mask):
+    """
+    Filter the flat array `data` by the boolean `mask`, returning the
+    filtered data and the CSR offsets of the segments after filtering.
+    """
+    cumulativeKept = np.zeros(len(mask) + 1, dtype=np.int64)
+    np.cumsum(mask, out=cumulativeKept[1:])
+    return data[mask], cumulativeKept[offsets]
+
+
+def coalescedArrayFromDataset(ds, offsetBegins, offsetEnds, maxGap=0):
+    """
+    Extract many one-dimensional slices from an HDF5 dataset at once.
+
+    Slices that overlap or abut (or lie within `maxGap` elements of
+    each other) are merged, so that each run of nearby slices is
+    fetched using a single hyperslab read.  The return value is a
+    pair ``(data, offsets)`` in CSR layout: slice `i` of the request,
+    in the order requested, is ``data[offsets[i]:offsets[i+1]]``.
+    """
+    offsetBegins = np.asarray(offsetBegins, dtype=np.int64)
+    offsetEnds   = np.asarray(offsetEnds,   dtype=np.int64)
+    lengths = offsetEnds - offsetBegins
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    if len(lengths) == 0:
+        return np.zeros(0, dtype=ds.dtype), offsets
+
+    order = np.argsort(offsetBegins, kind="mergesort")
+    b = offsetBegins[order]
+    e = offsetEnds[order]
+    # A new block begins wherever a slice starts beyond the furthest
+    # end seen so far
+    furthestEnd = np.maximum.accumulate(e)
+    isBlockStart = np.ones(len(b), dtype=bool)
+    isBlockStart[1:] = b[1:] > furthestEnd[:-1] + maxGap
+    blockStarts = np.flatnonzero(isBlockStart)
+    blockId = np.cumsum(isBlockStart) - 1
+    blockBegin = b[blockStarts]
+    blockEnd = furthestEnd[np.append(blockStarts[1:] - 1, len(b) - 1)]
+
+    blocks = [ arrayFromDataset(ds, bb, be)
+               for (bb, be) in zip(blockBegin, blockEnd) ]
+    buf = blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+    blockLengths = blockEnd - blockBegin
+    blockOffsets = np.cumsum(blockLengths) - blockLengths
+
+    sourceBegins = np.empty_like(b)
+    sourceBegins[order] = blockOffsets[blockId] + (b - blockBegin[blockId])
+    return buf[concatenatedRanges(sourceBegins, sourceBegins + lengths)], offsets
+
+
+def asRowNumbers(rowNumbers):
+    """
+    Normalize a row number specification (list or array of integers,
+    or boolean mask) to an integer array.
+    """
+    rowNumbers = np.asarray(rowNumbers)
+    if rowNumbers.dtype == bool:
+        return np.flatnonzero(rowNumbers)
+    else:
+        return rowNumbers.astype(np.int64)
+
+
+class ChunkCache(object):
+    """
+    A least-recently-used cache of decompressed chunks of
+    one-dimensional HDF5 datasets, bounded by a budget of `capacity`
+    bytes.
+
+    Slices are served out of whole chunks (as given by the dataset's
+    chunk shape; unchunked datasets are divided into blocks of
+    `BLOCK_LENGTH` elements), so that neighboring reads do not make
+    HDF5 decompress the same chunk over and over.  Chunks are keyed by
+    the caller-supplied dataset key plus the chunk index.  The `hits`
+    and `misses` counters record chunk lookups, to help size the
+    cache.
+    """
+    BLOCK_LENGTH = 16384
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size   = 0
+        self.hits   = 0
+        self.misses = 0
+        self._chunks = OrderedDict()
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def clear(self):
+        self._chunks.clear()
+        self.size = 0
+
+    def _chunk(self, key, ds, chunkIndex, chunkLength):
+        chunkKey = key + (chunkIndex,)
+        chunk = self._chunks.pop(chunkKey, None)
+        if chunk is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            chunkBegin = chunkIndex * chunkLength
+            chunkEnd   = min(chunkBegin + chunkLength, len(ds))
+            chunk = arrayFromDataset(ds, chunkBegin, chunkEnd)
+            self.size += chunk.nbytes
+            while self._chunks and self.size > self.capacity:
+                _, evicted = self._chunks.popitem(last=False)
+                self.size -= evicted.nbytes
+        self._chunks[chunkKey] = chunk
+        return chunk
+
+    def readSlice(self, key, ds, offsetBegin, offsetEnd):
+        """
+        Same semantics as arrayFromDataset(ds, offsetBegin,
+        offsetEnd); `key` (a tuple) must identify the dataset `ds`.
+        """
+        if offsetEnd <= offsetBegin:
+            return np.zeros(0, dtype=ds.dtype)
+        chunkLength = ds.chunks[0] if ds.chunks else self.BLOCK_LENGTH
+        firstChunk = offsetBegin // chunkLength
+        lastChunk  = (offsetEnd - 1) // chunkLength
+        chunks = [ self._chunk(key, ds, i, chunkLength)
+                   for i in xrange(firstChunk, lastChunk + 1) ]
+        start = offsetBegin - firstChunk * chunkLength
+        end   = start + (offsetEnd - offsetBegin)
+        # Always return a copy, so that callers cannot modify the
+        # cached chunk
+        if len(chunks) == 1:
+            return chunks[0][start:end].copy()
+        else:
+            return np.concatenate(chunks)[start:end]
+
+
 def splitFileContents(f, delimiter, BLOCKSIZE=8192):
     """
     Same semantics as f.read().split(delimiter), but with memory usage
@@ -82,13 +82,67 @@ def requiresPbi(method):
     return f
 
 class BamAlignment(AlignmentRecordMixin):
+    """
+    An alignment record in a BAM file, wrapping the pysam record.
+
+    Fields are decoded from the pysam record when first asked for, and
+    kept: the extents (`tStart`, `tEnd`, `rStart`, `rEnd`), the
+    `qStart`/`qEnd`/`HoleNumber` tags, the read group ID and the
+    unrolled CIGAR.  Columns of the bam.pbi index are read directly
+    from the index, by row number.
+
+    The read, reference, oriented CIGAR and transcript are likewise
+    kept once decoded, per `aligned`/`orientation` (and `style`), so
+    that asking for them again is free.  The CIGAR arrays are shared,
+    and so are read-only.
+    """
+    __slots__ = [ "peer", "bam", "rowNumber",
+                  "_tStart", "_tEnd", "_rStart", "_rEnd",
+                  "_qStart", "_qEnd", "_holeNumber", "_readGroupId",
+                  "_unrolledCigar", "_decoded" ]
+
     def __init__(self, bamReader, pysamAlignedRead, rowNumber=None):
-        #TODO: make these __slot__
         self.peer        = pysamAlignedRead
         self.bam         = bamReader
         self.rowNumber   = rowNumber
-        self.tStart      = self.peer.pos
-        self.tEnd        = self.peer.aend
+        self._tStart     = None
+        self._tEnd       = None
+        self._rStart     = None
+        self._rEnd       = None
+        self._qStart     = None
+        self._qEnd       = None
+        self._holeNumber = None
+        self._readGroupId = None
+        # Cache of unrolled cigar, in genomic orientation
+        self._unrolledCigar = None
+        # Cache of decoded read, reference, etc.
+        self._decoded = None
+
+    def _memoized(self, key, decode):
+        if self._decoded is None:
+            self._decoded = {}
+        value = self._decoded.get(key)
+        if value is None:
+            value = self._decoded[key] = decode()
+        return value
+
+    @property
+    def reader(self):
+        return self.bam
+
+    @property
+    def tStart(self):
+        if self._tStart is None:
+            self._tStart = self.peer.pos
+        return self._tStart
+
+    @property
+    def tEnd(self):
+        if self._tEnd is None:
+            self._tEnd = self.peer.aend
+        return self._tEnd
+
+    def _loadReadExtent(self):
         # Our terminology doesn't agree with pysam's terminology for
         # "query", "read".  This makes this code confusing.
         if self.peer.is_reverse:
@@ -97,24 +151,32 @@ class BamAlignment(AlignmentRecordMixin):
         else:
             clipLeft  = self.peer.qstart
             clipRight = self.peer.rlen - self.peer.qend
-        self.rStart = self.qStart + clipLeft
-        self.rEnd   = self.qEnd   - clipRight
-
-        # Cache of unrolled cigar, in genomic orientation
-        self._unrolledCigar = None
+        self._rStart = self.qStart + clipLeft
+        self._rEnd   = self.qEnd   - clipRight
 
+    @property
+    def rStart(self):
+        if self._rStart is None:
+            self._loadReadExtent()
+        return self._rStart
 
     @property
-    def reader(self):
-        return self.bam
+    def rEnd(self):
+        if self._rEnd is None:
+            self._loadReadExtent()
+        return self._rEnd
 
     @property
     def qStart(self):
-        return self.peer.opt("YS")
+        if self._qStart is None:
+            self._qStart = self.peer.opt("YS")
+        return self._qStart
 
     @property
     def qEnd(self):
-        return self.peer.opt("YE")
+        if self._qEnd is None:
+            self._qEnd = self.peer.opt("YE")
+        return self._qEnd
 
     @property
     def tId(self):
@@ -130,7 +192,9 @@ class BamAlignment(AlignmentRecordMixin):
 
     @property
     def HoleNumber(self):
-        return self.peer.opt("ZM")
+        if self._holeNumber is None:
+            self._holeNumber = self.peer.opt("ZM")
+        return self._holeNumber
 
     @property
     def MapQV(self):
@@ -192,9 +256,15 @@ class BamAlignment(AlignmentRecordMixin):
     def movieName(self):
         return self.readGroupInfo.MovieName
 
+    @property
+    def readGroupId(self):
+        if self._readGroupId is None:
+            self._readGroupId = int(self.peer.opt("RG")[:8], 16)
+        return self._readGroupId
+
     @property
     def readGroupInfo(self):
-        return self.bam.readGroupInfo(int(self.peer.opt("RG")[:8], 16))
+        return self.bam.readGroupInfo(self.readGroupId)
 
     @property
     def readType(self):
@@ -260,13 +330,17 @@ class BamAlignment(AlignmentRecordMixin):
         A text representation of the alignment moves (see Gusfield).
         This can be useful in pretty-printing an alignment.
         """
+        return self._memoized(("transcript", orientation, style),
+                              lambda: self._transcript(orientation, style))
+
+    def _transcript(self, orientation, style):
         uc = self.unrolledCigar(orientation)
         ref = np.fromstring(self.reference(aligned=True, orientation=orientation), dtype=np.int8)
         read = np.fromstring(self.read(aligned=True, orientation=orientation), dtype=np.int8)
         isMatch = (ref == read)
 
         # Disambiguate the "M" op
-        cigarPlus = uc
+        cigarPlus = uc.copy()
         cigarPlus[(~isMatch) & (cigarPlus == BAM_CMATCH)] = BAM_CDIFF   # 'X'
         cigarPlus[( isMatch) & (cigarPlus == BAM_CMATCH)] = BAM_CEQUAL  # '='
 
@@ -286,9 +360,13 @@ class BamAlignment(AlignmentRecordMixin):
     def reference(self, aligned=True, orientation="native"):
         if not (orientation == "native" or orientation == "genomic"):
             raise ValueError, "Bad `orientation` value"
-        tSeq = self.bam.referenceFasta[self.referenceName].sequence[self.tStart:self.tEnd]
+        return self._memoized(("reference", aligned, orientation),
+                              lambda: self._reference(aligned, orientation))
+
+    def _reference(self, aligned, orientation):
         shouldRC = orientation == "native" and self.isReverseStrand
-        tSeqOriented = reverseComplement(tSeq) if shouldRC else tSeq
+        tSeqOriented = self.bam.referenceSequence(self.referenceName,
+                                                  self.tStart, self.tEnd, shouldRC)
         if aligned:
             x = np.fromstring(tSeqOriented, dtype=np.int8)
             y = self._gapifyRef(x, orientation)
@@ -302,12 +380,20 @@ class BamAlignment(AlignmentRecordMixin):
         """
         if self._unrolledCigar is None:
             self._unrolledCigar = _unrollCigar(self.peer.cigar, exciseSoftClips=True)
+            self._unrolledCigar.flags.writeable = False
 
         if (orientation == "native" and self.isReverseStrand):
-            return self._unrolledCigar[::-1]
+            return self._memoized(("cigar", orientation),
+                                  lambda: self._readOnlyCopy(self._unrolledCigar[::-1]))
         else:
             return self._unrolledCigar
 
+    @staticmethod
+    def _readOnlyCopy(a):
+        a = a.copy()
+        a.flags.writeable = False
+        return a
+
 
     def referencePositions(self, aligned=True, orientation="native"):
         """
@@ -451,8 +537,8 @@ class BamAlignment(AlignmentRecordMixin):
     SubstitutionQV = _makePulseFeatureAccessor("SubstitutionQV")
 
     def read(self, aligned=True, orientation="native"):
-        feature = self.pulseFeature("read", aligned, orientation)
-        return feature.tostring()
+        return self._memoized(("read", aligned, orientation),
+                              lambda: self.pulseFeature("read", aligned, orientation).tostring())
 
     def __repr__(self):
         return "BAM alignment: %s  %3d  %9d  %9d" \
@@ -492,7 +578,7 @@ class BamAlignment(AlignmentRecordMixin):
     @requiresPbi
     def __getattr__(self, key):
         if key in self.bam.pbi.columnNames:
-            return self.bam.pbi[self.rowNumber][key]
+            return self.bam.pbi.column(key)[self.rowNumber]
         else:
             raise AttributeError, "no such column in pbi index"
 
@@ -501,6 +587,8 @@ class BamAlignment(AlignmentRecordMixin):
             return self.bam.pbi.columnNames
 
 class ClippedBamAlignment(BamAlignment):
+    __slots__ = []
+
     def __init__(self, aln, tStart, tEnd, rStart, rEnd, unrolledCigar):
         # Self-consistency checks
         assert tStart <= tEnd
@@ -511,14 +599,13 @@ class ClippedBamAlignment(BamAlignment):
         self.peer           = aln.peer
         self.bam            = aln.bam
         self.rowNumber      = aln.rowNumber
-        self.tStart         = tStart
-        self.tEnd           = tEnd
-        self.rStart         = rStart
-        self.rEnd           = rEnd
+        self._tStart        = tStart
+        self._tEnd          = tEnd
+        self._rStart        = rStart
+        self._rEnd          = rEnd
+        self._qStart        = aln._qStart
+        self._qEnd          = aln._qEnd
+        self._holeNumber    = aln._holeNumber
+        self._readGroupId   = aln._readGroupId
         self._unrolledCigar = unrolledCigar  # genomic orientation
-
-    def unrolledCigar(self, orientation="native"):
-        if orientation=="native" and self.isReverseStrand:
-            return self._unrolledCigar[::-1]
-        else:
-            return self._unrolledCigar
+        self._decoded       = None
@@ -30,20 +30,56 @@
 
 # Author: David Alexander
 
-__all__ = [ "BamReader", "IndexedBamReader" ]
+__all__ = [ "BamReader", "IndexedBamReader", "CigarBatch" ]
 
 from pysam import Samfile
 from pbcore.io import FastaTable
 from pbcore.chemistry import decodeTriple, ChemistryLookupError
+from pbcore.util.sequences import reverseComplement
 
-import numpy as np
-from itertools import groupby
+import numpy as np, warnings
+from collections import namedtuple, OrderedDict
+from itertools import chain, groupby
 from os.path import abspath, expanduser, exists
 
+from pbcore.io._utils import (asRowNumbers, concatenatedRanges, reversedSegmentsIndex,
+                              segmentedExclusiveCumsum)
 from .PacBioBamIndex import PacBioBamIndex
 from .BamAlignment import *
 from ._BamSupport import *
-from ._AlignmentMixin import AlignmentReaderMixin, IndexedAlignmentReaderMixin
+from ._AlignmentMixin import (AlignmentReaderMixin, IndexedAlignmentReaderMixin,
+                              PILEUP_BASES)
+
+# Position of each (ASCII) base in PILEUP_BASES, ignoring case; other
+# (IUPAC ambiguity) codes count as N
+_pileupBaseIndex = np.empty(256, dtype=int)
+_pileupBaseIndex.fill(PILEUP_BASES.index("N"))
+for (i, b) in enumerate(PILEUP_BASES):
+    _pileupBaseIndex[ord(b)] = i
+    _pileupBaseIndex[ord(b.lower())] = i
+
+# Unrolled CIGAR ops of many alignments, in CSR layout, with the
+# reference and read position of each alignment column
+CigarBatch = namedtuple("CigarBatch", ["ops", "offsets",
+                                       "referencePositions", "readPositions"])
+
+def _openSamfile(fname, threads):
+    """
+    Open the BAM file, asking pysam for `threads` decompression
+    threads.  Returns the Samfile and the number of threads it uses:
+    if the installed pysam does not take the `threads` argument, a
+    warning is issued and the file is read single-threaded.
+    """
+    if threads > 1:
+        try:
+            return Samfile(fname, "rb", threads=threads), threads
+        except TypeError as e:
+            # Only an unknown `threads` keyword is expected here
+            if "threads" not in str(e):
+                raise
+            warnings.warn("The installed pysam does not support threads=; "
+                          "reading %s with a single thread" % fname)
+    return Samfile(fname, "rb"), 1
 
 class _BamReaderBase(object):
     """
@@ -52,7 +88,22 @@ class _BamReaderBase(object):
     user instantiates the BamReader using the reference FASTA as the
     second argument, the BamReader will provide an interface
     compatible with CmpH5Reader.
+
+    With ``threads > 1``, the file is opened with `threads` BGZF
+    decompression threads.  Where the installed pysam does not
+    support them, a warning is issued and the file is read with a
+    single thread.
+
+    Reference substrings fetched for alignments (see
+    `referenceSequence`) are cut from fixed blocks of
+    `REFERENCE_BLOCK_SIZE` bases of the reference, kept in a
+    least-recently-used cache of `REFERENCE_CACHE_SIZE` bytes shared
+    by the alignments of the reader, so that overlapping alignments
+    reuse the same blocks.
     """
+    REFERENCE_BLOCK_SIZE = 1 << 16
+    REFERENCE_CACHE_SIZE = 1 << 24
+
     def _loadReferenceInfo(self):
         refRecords = self.peer.header["SQ"]
         refNames   = [r["SN"] for r in refRecords]
@@ -133,9 +184,12 @@ class _BamReaderBase(object):
             raise ReferenceMismatch, "FASTA file must contain superset of reference contigs in BAM"
         self.referenceFasta = ft
 
-    def __init__(self, fname, referenceFastaFname=None):
+    def __init__(self, fname, referenceFastaFname=None, threads=1):
         self.filename = fname = abspath(expanduser(fname))
-        self.peer = Samfile(fname, "rb")
+        self.peer, self._threads = _openSamfile(fname, threads)
+        self._referenceCache = OrderedDict()
+        self._referenceCacheSize = 0
+        self._readGroupHoleIndexArrays = None
         # Check for sortedness, index.
         # There doesn't seem to be a "public" way to do this right
         # now, but that's fine because we're going to have to rewrite
@@ -186,6 +240,38 @@ class _BamReaderBase(object):
     def referenceInfoTable(self):
         return self._referenceInfoTable
 
+    def referenceSequence(self, refName, start, end, reverseComplemented=False):
+        """
+        The bases [start, end) of reference `refName`, reverse
+        complemented if requested, from the reference FASTA.
+        """
+        blockSize = self.REFERENCE_BLOCK_SIZE
+        if end <= start:
+            return ""
+        firstBlock = start // blockSize
+        lastBlock  = (end - 1) // blockSize
+        blocks = [ self._referenceBlock(refName, i)
+                   for i in xrange(firstBlock, lastBlock + 1) ]
+        offset = start - firstBlock * blockSize
+        seq = "".join(blocks)[offset:offset + (end - start)]
+        if reverseComplemented:
+            seq = reverseComplement(seq)
+        return seq
+
+    def _referenceBlock(self, refName, blockIndex):
+        key = (refName, blockIndex)
+        block = self._referenceCache.pop(key, None)
+        if block is None:
+            blockStart = blockIndex * self.REFERENCE_BLOCK_SIZE
+            block = self.referenceFasta[refName].sequence[
+                blockStart:blockStart + self.REFERENCE_BLOCK_SIZE]
+            self._referenceCacheSize += len(block)
+            while self._referenceCache and self._referenceCacheSize > self.REFERENCE_CACHE_SIZE:
+                _, evicted = self._referenceCache.popitem(last=False)
+                self._referenceCacheSize -= len(evicted)
+        self._referenceCache[key] = block
+        return block
+
     #TODO: standard?  how about subread instead?  why capitalize ccs?
     # can we standardize this?  is cDNA an additional possibility
     @property
@@ -280,8 +366,8 @@ class BamReader(_BamReaderBase, AlignmentReaderMixin):
     Reader for a BAM with a bam.bai (SAMtools) index, but not a
     bam.pbi (PacBio) index.  Supports basic BAM operations.
     """
-    def __init__(self, fname, referenceFastaFname=None):
-        super(BamReader, self).__init__(fname, referenceFastaFname)
+    def __init__(self, fname, referenceFastaFname=None, threads=1):
+        super(BamReader, self).__init__(fname, referenceFastaFname, threads)
 
     def __iter__(self):
         self.peer.reset()
@@ -311,31 +397,261 @@ class IndexedBamReader(_BamReaderBase, IndexedAlignmentReaderMixin):
     ``bam.pbi`` (PacBio BAM index) file to enable random access by
     "row number" and to provide access to precomputed semantic
     information about the BAM records
+
+    The read locators serving `readsInRange` can be loaded from a
+    sidecar file written by ``pbi.writeReadLocatorCache``, given as
+    `readLocatorCache` (see `PacBioBamIndex`).
     """
-    def __init__(self, fname, referenceFastaFname=None):
-        super(IndexedBamReader, self).__init__(fname, referenceFastaFname)
+    def __init__(self, fname, referenceFastaFname=None, readLocatorCache=None,
+                 threads=1):
+        super(IndexedBamReader, self).__init__(fname, referenceFastaFname, threads)
         self.pbi = None
         pbiFname = self.filename + ".pbi"
         if exists(pbiFname):
-            self.pbi = PacBioBamIndex(pbiFname)
+            self.pbi = PacBioBamIndex(pbiFname, readLocatorCache)
         else:
-            raise ValueError, "IndexedBamReader requires bam.pbi index file"
+            raise ValueError, ("IndexedBamReader requires bam.pbi index file "
+                               "(see buildPacBioBamIndex)")
         assert len(self.pbi) == self.peer.mapped, "Corrupt or mismatched pbi index file"
+        self._readLocatorCacheFilename = readLocatorCache
+
+    def _constructorArgs(self):
+        referenceFastaFname = (self.referenceFasta.filename
+                               if self.isReferenceLoaded else None)
+        return (self.filename, referenceFastaFname, self._readLocatorCacheFilename,
+                self._threads)
+
+    def close(self):
+        super(IndexedBamReader, self).close()
+        if self.pbi is not None:
+            self.pbi.close()
 
     def atRowNumber(self, rn):
         offset = self.pbi.virtualFileOffset[rn]
         self.peer.seek(offset)
         return BamAlignment(self, next(self.peer), rn)
 
-    def readsInRange(self, winId, winStart, winEnd, justIndices=False):
+    def readsInRange(self, winId, winStart, winEnd, justIndices=False, filter=None):
         if isinstance(winId, str):
             winId = self.referenceInfo(winId).ID
         ix = self.pbi.rangeQuery(winId, winStart, winEnd)
+        if filter is not None:
+            ix = filter.apply(self, ix, winStart, winEnd)
         if justIndices:
             return ix
         else:
             return self[ix]
 
+    def _cigarBatch(self, alns, rowNumbers, orientation):
+        if len(alns) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return CigarBatch(empty, np.zeros(1, dtype=np.int64), empty, empty)
+        # CIGAR runs of all the alignments, less the clipping ops
+        cigars = [ a.peer.cigar for a in alns ]
+        nRuns = np.array(map(len, cigars), dtype=np.int64)
+        runs = np.fromiter(chain.from_iterable(chain.from_iterable(cigars)),
+                           dtype=np.int64, count=2 * nRuns.sum()).reshape(-1, 2)
+        runAln = np.repeat(np.arange(len(alns)), nRuns)
+        keep = (runs[:, 0] != BAM_CSOFT_CLIP) & (runs[:, 0] != BAM_CHARD_CLIP)
+        runOps, runLengths, runAln = runs[keep, 0], runs[keep, 1], runAln[keep]
+
+        ops = np.repeat(runOps, runLengths)
+        lengths = np.bincount(runAln, weights=runLengths,
+                              minlength=len(alns)).astype(np.int64)
+        offsets = np.zeros(len(alns) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        isReverse = self.pbi.isReverseStrand[rowNumbers] == 1
+        if orientation == "native":
+            ops = ops[reversedSegmentsIndex(offsets, isReverse)]
+            refBackwards, readBackwards = isReverse, np.zeros_like(isReverse)
+        else:
+            refBackwards, readBackwards = np.zeros_like(isReverse), isReverse
+
+        def positions(nonGapMask, start, end, backwards):
+            # Position of each column, counting up from `start`, or
+            # down from `end` for the `backwards` alignments
+            steps = segmentedExclusiveCumsum(nonGapMask, offsets)
+            backwards = np.repeat(backwards, lengths)
+            return np.where(backwards,
+                            np.repeat(end.astype(np.int64) - 1, lengths) - steps,
+                            np.repeat(start.astype(np.int64), lengths) + steps)
+
+        refPos  = positions(ops != BAM_CINS, self.pbi.tStart[rowNumbers],
+                            self.pbi.tEnd[rowNumbers], refBackwards)
+        readPos = positions(ops != BAM_CDEL, self.pbi.rStart[rowNumbers],
+                            self.pbi.rEnd[rowNumbers], readBackwards)
+        return CigarBatch(ops, offsets, refPos, readPos)
+
+    def cigarBatch(self, rowNumbers, orientation="native"):
+        """
+        Unroll the CIGARs of the alignments at `rowNumbers` all at
+        once.  Returns a `CigarBatch`, holding the unrolled CIGAR ops
+        of the alignments, clipping ops removed, concatenated in the
+        order requested (`ops`), an array of ``len(rowNumbers) + 1``
+        `offsets` such that the ops for ``rowNumbers[i]`` are
+        ``ops[offsets[i]:offsets[i+1]]``, and the
+        `referencePositions` and `readPositions` of every column.
+
+        The arrays for each alignment are the same as given by
+        `BamAlignment.unrolledCigar`, `referencePositions` and
+        `readPositions` (with ``aligned=True``) for the same
+        `orientation`, but are computed in a single vectorized pass.
+        """
+        if not (orientation == "native" or orientation == "genomic"):
+            raise ValueError, "Bad `orientation` value"
+        rowNumbers = asRowNumbers(rowNumbers)
+        return self._cigarBatch(self[rowNumbers], rowNumbers, orientation)
+
+    def _pulseFeatureBatch(self, alns, rowNumbers, featureName, aligned,
+                           orientation, cigarBatch):
+        if featureName == "read":
+            kind_, dtype_ = "base", np.int8
+            strings = [ a.peer.seq for a in alns ]
+        elif featureName == "QualityValue":
+            kind_, dtype_ = "raw", np.uint8
+            strings = [ a.peer.qual for a in alns ]
+        else:
+            tag, kind_, dtype_ = PULSE_FEATURE_TAGS[featureName]
+            strings = [ a.peer.opt(tag) for a in alns ]
+        # The tags of the records, end to end, as stored in the BAM
+        # (genomic orientation)
+        raw = np.fromstring("".join(strings), dtype=np.uint8)
+        rawLengths = np.array(map(len, strings), dtype=np.int64)
+        rawOffsets = np.zeros(len(alns) + 1, dtype=np.int64)
+        np.cumsum(rawLengths, out=rawOffsets[1:])
+
+        # [s, e) delimits the aligned read within the native-oriented
+        # tag, as in BamAlignment.pulseFeature; for reverse strand
+        # records, that is [len - e, len - s) of the stored tag
+        isReverse = self.pbi.isReverseStrand[rowNumbers] == 1
+        qStart = np.array([ a.qStart for a in alns ], dtype=np.int64)
+        s = self.pbi.rStart[rowNumbers].astype(np.int64) - qStart
+        e = self.pbi.rEnd[rowNumbers].astype(np.int64)   - qStart
+        begins = rawOffsets[:-1] + np.where(isReverse, rawLengths - e, s)
+        ends   = rawOffsets[:-1] + np.where(isReverse, rawLengths - s, e)
+        data = raw[concatenatedRanges(begins, ends)]
+        offsets = np.zeros(len(alns) + 1, dtype=np.int64)
+        np.cumsum(ends - begins, out=offsets[1:])
+
+        if kind_ == "qv":
+            data -= 33
+        if orientation == "native":
+            data = data[reversedSegmentsIndex(offsets, isReverse)]
+            if kind_ == "base":
+                complement = np.repeat(isReverse, np.diff(offsets))
+                data = np.where(complement, COMPLEMENT_ASCII[data], data)
+        data = data.view(dtype_)
+
+        if not aligned:
+            return data, offsets
+        if data.dtype == np.int8:
+            gapCode = ord("-")
+        else:
+            gapCode = data.dtype.type(-1)
+        alnData = np.empty(len(cigarBatch.ops), dtype=data.dtype)
+        alnData.fill(gapCode)
+        alnData[cigarBatch.ops != BAM_CDEL] = data
+        return alnData, cigarBatch.offsets
+
+    def pulseFeatureBatch(self, rowNumbers, featureName,
+                          aligned=True, orientation="native"):
+        """
+        Access pulse features for many alignments at once.  This is
+        equivalent to calling `BamAlignment.pulseFeature` on each of
+        the alignments at `rowNumbers`, but the tags of all of them
+        are decoded together, as flat arrays: QV offsets, strand
+        flips and base complements are applied with whole-array
+        operations and lookup tables rather than per record.
+
+        For a single `featureName`, the return value is a pair
+        ``(data, offsets)``: the feature arrays for the alignments,
+        concatenated in the order requested, and an array of
+        ``len(rowNumbers) + 1`` offsets such that the feature for
+        ``rowNumbers[i]`` is ``data[offsets[i]:offsets[i+1]]``.  Given
+        a list of feature names, the records are read once and the
+        return value is a dict mapping each name to such a pair.
+        """
+        if not (orientation == "native" or orientation == "genomic"):
+            raise ValueError, "Bad `orientation` value"
+        rowNumbers = asRowNumbers(rowNumbers)
+        alns = self[rowNumbers]
+        cigarBatch = self._cigarBatch(alns, rowNumbers, orientation) if aligned else None
+        if isinstance(featureName, basestring):
+            return self._pulseFeatureBatch(alns, rowNumbers, featureName, aligned,
+                                           orientation, cigarBatch)
+        else:
+            return { name : self._pulseFeatureBatch(alns, rowNumbers, name, aligned,
+                                                    orientation, cigarBatch)
+                     for name in featureName }
+
+    def _pileupColumns(self, rowNumbers):
+        # Alignment columns for all the rows, in genomic orientation
+        rowNumbers = asRowNumbers(rowNumbers)
+        alns = self[rowNumbers]
+        if len(alns) == 0:
+            empty = np.zeros(0, dtype=int)
+            return empty, empty, np.zeros(0, dtype=bool)
+        batch = self._cigarBatch(alns, rowNumbers, "genomic")
+
+        # The aligned bases of the BAM records are in genomic
+        # orientation already
+        reads = np.fromstring("".join(a.peer.query for a in alns), dtype=np.uint8)
+        alignedReads = np.empty(len(batch.ops), dtype=np.uint8)
+        alignedReads.fill(ord("-"))
+        alignedReads[batch.ops != BAM_CDEL] = reads
+        return (batch.referencePositions, _pileupBaseIndex[alignedReads],
+                batch.ops == BAM_CINS)
+
+    def clipToWindow(self, rowNumbers, refStart, refEnd):
+        """
+        Clip many alignments at once to the reference window
+        [`refStart`, `refEnd`), which each of them must overlap.
+
+        Returns a recarray with one record per row number, holding the
+        ``tStart``, ``tEnd``, ``rStart`` and ``rEnd`` of
+        ``b[rowNumber].clippedTo(refStart, refEnd)``, computed from a
+        `cigarBatch` without creating a clipped alignment per row.
+        """
+        rowNumbers = asRowNumbers(rowNumbers)
+        tStart = self.pbi.tStart[rowNumbers].astype(np.int64)
+        tEnd   = self.pbi.tEnd[rowNumbers].astype(np.int64)
+        if refStart >= refEnd or np.any((refStart >= tEnd) | (refEnd <= tStart)):
+            raise IndexError, "Clipping query does not overlap alignment"
+        clipRefStart = np.maximum(tStart, refStart)
+        clipRefEnd   = np.minimum(tEnd,   refEnd)
+
+        batch = self.cigarBatch(rowNumbers, orientation="genomic")
+        n = len(rowNumbers)
+        lengths = np.diff(batch.offsets)
+        segment = np.repeat(np.arange(n), lengths)
+        column  = np.arange(batch.offsets[-1]) - np.repeat(batch.offsets[:-1], lengths)
+
+        # Clip points within each alignment, as in BamAlignment.clippedTo:
+        #   clipStart = bisect_right(refPositions, clipRefStart) - 1
+        #   clipEnd   = bisect_left(refPositions, clipRefEnd)
+        refPos = batch.referencePositions
+        clipStart = np.bincount(segment[refPos <= np.repeat(clipRefStart, lengths)],
+                                minlength=n) - 1
+        clipEnd   = np.bincount(segment[refPos <  np.repeat(clipRefEnd, lengths)],
+                                minlength=n)
+        inClip = ((column >= np.repeat(clipStart, lengths)) &
+                  (column <  np.repeat(clipEnd,   lengths)))
+        readLength = np.bincount(segment[inClip & (batch.ops != BAM_CDEL)],
+                                 minlength=n)
+        readPosAtClipStart = batch.readPositions[batch.offsets[:-1] + clipStart]
+        isReverse = self.pbi.isReverseStrand[rowNumbers] == 1
+
+        clipped = np.recarray(n, dtype=[ (name, np.uint32) for name in
+                                         ("tStart", "tEnd", "rStart", "rEnd") ])
+        clipped.tStart = clipRefStart
+        clipped.tEnd   = clipRefEnd
+        clipped.rStart = np.where(isReverse, readPosAtClipStart + 1 - readLength,
+                                  readPosAtClipStart)
+        clipped.rEnd   = np.where(isReverse, readPosAtClipStart + 1,
+                                  readPosAtClipStart + readLength)
+        return clipped
+
     def __iter__(self):
         for rn in xrange(len(self.pbi)):
             yield self.atRowNumber(rn)
@@ -343,23 +659,47 @@ class IndexedBamReader(_BamReaderBase, IndexedAlignmentReaderMixin):
     def __len__(self):
         return len(self.pbi)
 
+    def atRowNumbers(self, rowNumbers):
+        """
+        The records at `rowNumbers` (an array of row numbers), in the
+        order requested.
+
+        The records are read in file order: the reader seeks only
+        when the next record wanted lies in a different BGZF block
+        than the current position, and otherwise reads through the
+        intervening records of the block it has already decompressed.
+        """
+        rowNumbers = asRowNumbers(rowNumbers)
+        uniqueRows, inverse = np.unique(rowNumbers, return_inverse=True)
+        offsets = self.pbi.virtualFileOffset[uniqueRows]
+        records = [None] * len(uniqueRows)
+        for i in np.argsort(offsets, kind="mergesort"):
+            offset = int(offsets[i])
+            position = self.peer.tell()
+            if (position >> 16) != (offset >> 16) or position > offset:
+                self.peer.seek(offset)
+            else:
+                while position < offset:
+                    next(self.peer)
+                    position = self.peer.tell()
+            records[i] = BamAlignment(self, next(self.peer), uniqueRows[i])
+        return [ records[i] for i in inverse ]
+
     def __getitem__(self, rowNumbers):
         if (isinstance(rowNumbers, int) or
             issubclass(type(rowNumbers), np.integer)):
             return self.atRowNumber(rowNumbers)
         elif isinstance(rowNumbers, slice):
-            return [ self.atRowNumber(r)
-                     for r in xrange(*rowNumbers.indices(len(self)))]
+            return self.atRowNumbers(np.arange(*rowNumbers.indices(len(self))))
         elif isinstance(rowNumbers, list) or isinstance(rowNumbers, np.ndarray):
             if len(rowNumbers) == 0:
                 return []
             else:
                 entryType = type(rowNumbers[0])
-                if entryType == int or issubclass(entryType, np.integer):
-                    return [ self.atRowNumber(r) for r in rowNumbers ]
-                elif entryType == bool or issubclass(entryType, np.bool_):
-                    return [ self.atRowNumber(r) for r in np.flatnonzero(rowNumbers) ]
-                    raise TypeError, "Invalid type for IndexedBamReader slicing"
+                if (entryType == int or issubclass(entryType, np.integer) or
+                    entryType == bool or issubclass(entryType, np.bool_)):
+                    return self.atRowNumbers(rowNumbers)
+        raise TypeError, "Invalid type for IndexedBamReader slicing"
 
     def __getattr__(self, key):
         if key in self.pbi.columnNames:
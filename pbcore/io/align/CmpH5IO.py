@@ -31,25 +31,38 @@
 # Author: David Alexander
 __all__ = [ "CmpH5Reader",
             "CmpH5Alignment",
+            "LazyAlignmentIndex",
+            "KineticsMatrix",
             "EmptyCmpH5Error" ]
 
 import h5py, numpy as np
 from bisect import bisect_left, bisect_right
-from collections import Counter, OrderedDict
+from collections import Counter, OrderedDict, namedtuple
 from itertools import groupby
 from os.path import abspath, expanduser
-from pbcore.io.rangeQueries import makeReadLocator
-from pbcore.io._utils import rec_join, arrayFromDataset
+from pbcore.io.rangeQueries import (makeReadLocatorFromColumns, writeReadLocatorCache,
+                                    openReadLocatorCache, readLocatorColumnsFromCache,
+                                    readLocatorColumns)
+from pbcore.io._utils import (rec_join, arrayFromDataset, asRowNumbers, ChunkCache,
+                              coalescedArrayFromDataset, concatenatedRanges,
+                              H5FileMap, reversedSegmentsIndex, compressedSegments,
+                              segmentedExclusiveCumsum)
 from pbcore.io.FastaIO import splitFastaHeader
 from pbcore.chemistry import decodeTriple, ChemistryLookupError
 
-from ._AlignmentMixin import AlignmentRecordMixin, IndexedAlignmentReaderMixin
+from ._AlignmentMixin import (AlignmentRecordMixin, IndexedAlignmentReaderMixin,
+                              PILEUP_BASES)
 
 # ========================================
 #  Data manipulation routines.
 #
 GAP = 0b0000
 
+# Pulse features of the reads in a reference window, tabulated by
+# reference position (see `CmpH5Reader.kineticsMatrix`)
+KineticsMatrix = namedtuple("KineticsMatrix", ["refStart", "refEnd",
+                                               "rowNumbers", "features"])
+
 _basemap =  { 0b0000 : ord("-"),
               0b0001 : ord("A"),
               0b0010 : ord("C"),
@@ -72,6 +85,15 @@ for (e, v) in _basemap.iteritems():
 for (e, v) in _cBasemap.iteritems():
     _cBasemapArray[e] = v
 
+# Position of each base in PILEUP_BASES, indexed by (complement?,
+# encoding); other (ambiguous) encodings count as N
+_pileupBaseIndex = np.empty(shape=(2, max(_basemap.keys()) + 1), dtype=int)
+_pileupBaseIndex.fill(PILEUP_BASES.index("N"))
+for (e, v) in _basemap.iteritems():
+    _pileupBaseIndex[0, e] = PILEUP_BASES.index(chr(v))
+for (e, v) in _cBasemap.iteritems():
+    _pileupBaseIndex[1, e] = PILEUP_BASES.index(chr(v))
+
 _baseEncodingToInt = np.array([-1]*16)
 _baseEncodingToInt[0b0000] = 0
 _baseEncodingToInt[0b0001] = 1
@@ -115,6 +137,25 @@ _exoneratePlusTranscriptTable = \
                   " |||||Z"
                   "ZZZZZZZ", dtype=np.uint8).reshape(7, 7)
 
+_transcriptTables = { "gusfield"   : _gusfieldTranscriptTable,
+                      "cigar"      : _cigarTranscriptTable,
+                      "exonerate"  : _exonerateTranscriptTable,
+                      "exonerate+" : _exoneratePlusTranscriptTable }
+
+# Lookup tables decoding alignment array bytes directly.  The read
+# and reference tables are indexed by (complement?, byte).
+_alignmentBytes = np.arange(256)
+_readDecodingTable = \
+    np.vstack([_basemapArray[_alignmentBytes >> 4],
+               _cBasemapArray[_alignmentBytes >> 4]]).view(np.uint8)
+_referenceDecodingTable = \
+    np.vstack([_basemapArray[_alignmentBytes & 0b1111],
+               _cBasemapArray[_alignmentBytes & 0b1111]]).view(np.uint8)
+_transcriptDecodingTables = \
+    { style : tbl[_baseEncodingToInt[_alignmentBytes >> 4],
+                  _baseEncodingToInt[_alignmentBytes & 0b1111]]
+      for (style, tbl) in _transcriptTables.iteritems() }
+
 class EmptyCmpH5Error(Exception):
     """An exception raised when CmpH5Reader tries to read from a
     cmp.h5 with no alignments.
@@ -145,24 +186,31 @@ def referenceFromAlignmentArray(a, gapped=True, complement=False):
         r = r[r != ord("-")]
     return  r.tostring()
 
-def ungappedPulseArray(a):
+def pulseArrayNonGapMask(a):
     """
-    Return a pulse array with encoded gaps removed.
+    Return a boolean mask identifying the non-gap entries of a pulse
+    array.
     """
     dtype = a.dtype
     if dtype == np.float32:
-        return a[~np.isnan(a)]
+        return ~np.isnan(a)
     elif dtype == np.uint8:
-        return a[a != np.uint8(-1)]
+        return a != np.uint8(-1)
     elif dtype == np.uint16:
-        return a[a != np.uint16(-1)]
+        return a != np.uint16(-1)
     elif dtype == np.uint32:
-        return a[a != np.uint32(-1)]
+        return a != np.uint32(-1)
     elif dtype == np.int8:
-        return a[a != ord("-")]
+        return a != ord("-")
     else:
         raise Exception, "Invalid pulse array type"
 
+def ungappedPulseArray(a):
+    """
+    Return a pulse array with encoded gaps removed.
+    """
+    return a[pulseArrayNonGapMask(a)]
+
 
 
 # ========================================
@@ -185,6 +233,71 @@ OFFSET_TABLE_DTYPE = [ ("ID",       np.uint32),
                        ("EndRow",   np.uint32) ]
 
 
+class LazyAlignmentIndex(object):
+    """
+    A stand-in for the alignment index recarray that reads from the
+    ``/AlnInfo/AlnIndex`` dataset only what is asked of it.
+
+    Columns (``idx.MapQV``, ``idx["MapQV"]``) are read from the file
+    the first time they are accessed and kept thereafter; rows
+    (``idx[i]``, ``idx[i:j]``, ``idx[rowNumbers]``) are read from the
+    file on each access, and returned as records of the usual
+    alignment index dtype.
+    """
+    def __init__(self, dataset):
+        self._dataset = dataset
+        self._columns = {}
+
+    def __len__(self):
+        return len(self._dataset)
+
+    @property
+    def dtype(self):
+        return np.dtype(ALIGNMENT_INDEX_DTYPE)
+
+    def column(self, columnName):
+        column = self._columns.get(columnName)
+        if column is None:
+            try:
+                j = ALIGNMENT_INDEX_COLUMNS.index(columnName)
+            except ValueError:
+                raise ValueError("no field of name %s" % columnName)
+            column = self._dataset[:, j]
+            self._columns[columnName] = column
+        return column
+
+    def _rows(self, rowNumbers):
+        # h5py point selections must be increasing and free of duplicates
+        uniqueRows, inverse = np.unique(rowNumbers, return_inverse=True)
+        if len(uniqueRows) == 0:
+            return np.zeros((0, len(ALIGNMENT_INDEX_COLUMNS)), dtype=np.uint32)
+        return self._dataset[uniqueRows.tolist(), :][inverse]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple) and len(key) == 1:
+            key = key[0]
+        if isinstance(key, basestring):
+            return self.column(key)
+        elif isinstance(key, (int, long, np.integer)):
+            if key < 0:
+                key += len(self)
+            raw = self._dataset[key:key+1, :]
+            return raw.view(dtype=ALIGNMENT_INDEX_DTYPE).view(np.recarray)[0, 0]
+        elif isinstance(key, slice):
+            raw = self._dataset[key, :]
+        else:
+            raw = self._rows(asRowNumbers(key))
+        return raw.view(dtype=ALIGNMENT_INDEX_DTYPE).view(np.recarray).flatten()
+
+    def __getattr__(self, key):
+        if key in ALIGNMENT_INDEX_COLUMNS:
+            return self.column(key)
+        raise AttributeError(key)
+
+    def __dir__(self):
+        return ALIGNMENT_INDEX_COLUMNS
+
+
 def _makePulseFeatureAccessor(featureName):
     def f(self, aligned=True, orientation="native"):
         return self.pulseFeature(featureName, aligned, orientation)
@@ -414,8 +527,8 @@ class CmpH5Alignment(AlignmentRecordMixin):
         Direct access to the raw, encoded aligment array, which is a
         packed representation of the aligned read and reference.
         """
-        alnDs = self.alignmentGroup["AlnArray"]
-        alnArray = arrayFromDataset(alnDs, self.Offset_begin, self.Offset_end)
+        alnArray = self.cmpH5._alignmentDataSlice(self.AlnGroupID, "AlnArray",
+                                                  self.Offset_begin, self.Offset_end)
         if self.RCRefStrand and (orientation == "genomic"):
             return alnArray[::-1]
         else:
@@ -426,14 +539,7 @@ class CmpH5Alignment(AlignmentRecordMixin):
         A text representation of the alignment moves (see Gusfield).
         This can be useful in pretty-printing an alignment.
         """
-        if style == "exonerate+":
-            tbl = _exoneratePlusTranscriptTable
-        elif style == "exonerate":
-            tbl = _exonerateTranscriptTable
-        elif style == "cigar":
-            tbl = _cigarTranscriptTable
-        else:
-            tbl = _gusfieldTranscriptTable
+        tbl = _transcriptTables.get(style, _gusfieldTranscriptTable)
         alnArr = self.alignmentArray(orientation)
         readBaseInts = _baseEncodingToInt[alnArr >> 4]
         refBaseInts  = _baseEncodingToInt[alnArr  & 0b1111]
@@ -515,8 +621,8 @@ class CmpH5Alignment(AlignmentRecordMixin):
         """
         Access a pulse feature by name.
         """
-        pulseDataset = self.alignmentGroup[featureName]
-        pulseArray = arrayFromDataset(pulseDataset, self.Offset_begin, self.Offset_end)
+        pulseArray = self.cmpH5._alignmentDataSlice(self.AlnGroupID, featureName,
+                                                    self.Offset_begin, self.Offset_end)
         if self.RCRefStrand and orientation == "genomic":
             alignedPulseArray = pulseArray[::-1]
         else:
@@ -536,7 +642,7 @@ class CmpH5Alignment(AlignmentRecordMixin):
     SubstitutionQV = _makePulseFeatureAccessor("SubstitutionQV")
 
     def __getattr__(self, key):
-        return self.cmpH5.alignmentIndex[self.rowNumber][key]
+        return self.cmpH5.alignmentIndex[key][self.rowNumber]
 
     def __repr__(self):
         return "CmpH5 alignment: %s  %3d  %9d  %9d" \
@@ -664,8 +770,43 @@ class CmpH5Reader(IndexedAlignmentReaderMixin):
         >>> sum(aln.readLength for aln in c)
         26103
 
+    Reads of alignment and pulse data for individual alignments can
+    be served from a cache of decompressed HDF5 chunks, which pays off
+    when neighboring alignments are visited in turn.  The cache is
+    enabled by passing a byte budget as `chunkCacheSize`; its hit and
+    miss counts are available from the `chunkCache` attribute.
+
+    Opening a file normally reads the whole alignment index into
+    memory.  With ``lazyIndex=True`` the index is instead read on
+    demand: each column the first time it is used, and, for range
+    queries, only the rows belonging to the contig being queried
+    (see `LazyAlignmentIndex`).  Field access via the `alignmentIndex`,
+    as well as the `c.MapQV`-style shorthand, works in either mode.
+
+    The read locator for a contig, which serves `readsInRange`, is
+    built the first time the contig is queried.  The arrays backing
+    the locators can be saved to a sidecar file using
+    `writeReadLocatorCache`; a reader opened with
+    ``readLocatorCache=<sidecar filename>`` then loads each contig's
+    locator from the sidecar instead of computing it.  A missing
+    sidecar, or one made for a different file (or for this file
+    before it was last modified), is ignored.
+
+    Range queries do not require the file to be sorted: for a file
+    lacking the ``/RefGroup/OffsetTable``, the read locator searches
+    the contig's alignments in a virtual order by tStart, computed in
+    memory (see `readLocatorColumns`), and returns the rows in that
+    order.  Such locators can be saved to a sidecar like any other.
+
+    Alignment and pulse datasets stored contiguously and uncompressed
+    are read through a single memory map of the file (see
+    `H5FileMap`), bypassing HDF5 and the chunk cache; other datasets
+    are read through HDF5.  Either way, the arrays returned by
+    `CmpH5Alignment` accessors are fresh, writable copies.
+
     """
-    def __init__(self, filenameOrH5File):
+    def __init__(self, filenameOrH5File, chunkCacheSize=0, lazyIndex=False,
+                 readLocatorCache=None):
         if isinstance(filenameOrH5File, h5py.File):
             if filenameOrH5File.mode != "r":
                 raise ValueError("HDF5 files used by CmpH5Reader must be opened read-only!")
@@ -678,32 +819,61 @@ class CmpH5Reader(IndexedAlignmentReaderMixin):
             except IOError:
                 raise IOError, ("Invalid or nonexistent cmp.h5 file %s" % filenameOrH5File)
 
+        if chunkCacheSize:
+            self.chunkCache = ChunkCache(chunkCacheSize)
+        else:
+            self.chunkCache = None
+        self._lazyIndex = lazyIndex
+        self._fileMap = H5FileMap(self.file)
+
         self._loadAlignmentInfo()
         self._loadMovieInfo()
         self._loadReferenceInfo()
         self._loadMiscInfo()
 
+        self._readGroupHoleIndexArrays = None
+        self._rowsByRefGroup = None
+        self._isReverseStrand = None
+        self._readLocatorCacheFilename = readLocatorCache
+        if readLocatorCache is not None:
+            self._readLocatorCache = openReadLocatorCache(readLocatorCache,
+                                                          self.filename, len(self))
+        else:
+            self._readLocatorCache = None
+
         # These are loaded on demand
         self._readGroupTable = None
         self._readGroupDict  = None
 
+    def _constructorArgs(self):
+        capacity = self.chunkCache.capacity if self.chunkCache is not None else 0
+        return (self.filename, capacity, self._lazyIndex,
+                self._readLocatorCacheFilename)
+
     def _loadAlignmentInfo(self):
         if len(self.file["/AlnInfo/AlnIndex"]) == 0:
             raise EmptyCmpH5Error("Empty cmp.h5 file, cannot be read by CmpH5Reader")
-        rawAlignmentIndex = self.file["/AlnInfo/AlnIndex"].value
-        self._alignmentIndex = rawAlignmentIndex.view(dtype = ALIGNMENT_INDEX_DTYPE) \
-                                                .view(np.recarray)                   \
-                                                .flatten()
+        if self._lazyIndex:
+            self._alignmentIndex = LazyAlignmentIndex(self.file["/AlnInfo/AlnIndex"])
+        else:
+            rawAlignmentIndex = self.file["/AlnInfo/AlnIndex"].value
+            self._alignmentIndex = rawAlignmentIndex.view(dtype = ALIGNMENT_INDEX_DTYPE) \
+                                                    .view(np.recarray)                   \
+                                                    .flatten()
 
         # This is the only sneaky part of this whole class.  We do not
         # store the raw h5py group object; rather we cache a dict of {
         # dataset_name -> dataset }.  This way we avoid B-tree
-        # scanning in basic data access.
+        # scanning in basic data access.  Alignment and pulse data are
+        # read through a second such dict, in which the datasets
+        # stored contiguously are replaced by views of the file map.
         self._alignmentGroupById = {}
+        self._alignmentDataById = {}
         for (alnGroupId, alnGroupPath) in zip(self.file["/AlnGroup/ID"],
                                               self.file["/AlnGroup/Path"]):
             alnGroup = self.file[alnGroupPath]
             self._alignmentGroupById[alnGroupId] = dict(alnGroup.items())
+            self._alignmentDataById[alnGroupId] = self._fileMap.datasets(alnGroup)
 
 
     def _loadMovieInfo(self):
@@ -798,11 +968,6 @@ class CmpH5Reader(IndexedAlignmentReaderMixin):
                     self._referenceDict[record.FullName] = record
                     self._referenceDict[record.MD5]      = record
 
-                if self.isSorted:
-                    readLocator = makeReadLocator(self, record.ID)
-                    self._readLocatorByKey[record.ID] = readLocator
-                    self._readLocatorByKey[shortName] = readLocator
-
     def _loadMiscInfo(self):
         if "NumPasses" in self.file["/AlnInfo"]:
             self.numPasses = self.file["/AlnInfo/NumPasses"].value
@@ -1010,6 +1175,17 @@ class CmpH5Reader(IndexedAlignmentReaderMixin):
     def alignmentGroup(self, alnGroupId):
         return self._alignmentGroupById[alnGroupId]
 
+    def _alignmentDataSlice(self, alnGroupId, datasetName, offsetBegin, offsetEnd):
+        ds = self._alignmentDataById[alnGroupId][datasetName]
+        if isinstance(ds, np.ndarray):
+            # Copy out of the file map, so callers get a writable array
+            return np.array(arrayFromDataset(ds, offsetBegin, offsetEnd))
+        elif self.chunkCache is None:
+            return arrayFromDataset(ds, offsetBegin, offsetEnd)
+        else:
+            return self.chunkCache.readSlice((alnGroupId, datasetName),
+                                             ds, offsetBegin, offsetEnd)
+
     @property
     def movieNames(self):
         return set([mi.Name for mi in self._movieDict.values()])
@@ -1018,6 +1194,14 @@ class CmpH5Reader(IndexedAlignmentReaderMixin):
     def ReadGroupID(self):
         return self.MovieID
 
+    @property
+    def isReverseStrand(self):
+        # Computed over the whole alignment index once, as batches and
+        # filters look it up for a few rows at a time
+        if self._isReverseStrand is None:
+            self._isReverseStrand = self.RCRefStrand == 1
+        return self._isReverseStrand
+
     @property
     def readGroupTable(self):
         # TODO: add doctest
@@ -1079,7 +1263,7 @@ class CmpH5Reader(IndexedAlignmentReaderMixin):
         """
         return self._referenceDict[key]
 
-    def readsInRange(self, refKey, refStart, refEnd, justIndices=False):
+    def readsInRange(self, refKey, refStart, refEnd, justIndices=False, filter=None):
         """
         Get a list of reads overlapping (i.e., intersecting---not
         necessarily spanning) a given reference window.
@@ -1095,6 +1279,10 @@ class CmpH5Reader(IndexedAlignmentReaderMixin):
         The contig key can be either the ``RefID``, or the short name
         (FASTA header up to first space).
 
+        If an `AlignmentFilter` is given as `filter`, only the reads
+        passing it are returned; the filter is evaluated on the
+        alignment index, before any `CmpH5Alignment` is created.
+
         .. doctest::
 
             >>> c.readsInRange(1, 0, 1000) # doctest: +NORMALIZE_WHITESPACE
@@ -1105,15 +1293,60 @@ class CmpH5Reader(IndexedAlignmentReaderMixin):
             >>> rowNumbers
             array([0, 1], dtype=uint32)
         """
-
-        if not self.isSorted:
-            raise Exception, "CmpH5 is not sorted"
-        rowNumbers = self._readLocatorByKey[refKey](refStart, refEnd, justIndices=True)
+        rowNumbers = self._readLocator(refKey)(refStart, refEnd, justIndices=True)
+        if filter is not None:
+            rowNumbers = filter.apply(self, rowNumbers, refStart, refEnd)
         if justIndices:
             return rowNumbers
         else:
             return self[rowNumbers]
 
+    def _readLocatorColumns(self, refInfo):
+        columns = readLocatorColumnsFromCache(self._readLocatorCache, refInfo.ID)
+        if columns is None and self.isSorted:
+            # The contig's rows of a sorted file are contiguous, and
+            # sorted by tStart
+            rows = self.alignmentIndex[refInfo.StartRow:refInfo.EndRow]
+            columns = [ np.arange(refInfo.StartRow, refInfo.EndRow, dtype=np.uint32),
+                        rows.tStart, rows.tEnd, rows.nBackRead, rows.nReadOverlap ]
+        elif columns is None:
+            # Search a virtual sort order of the contig's rows
+            if self._rowsByRefGroup is None:
+                # Rows grouped by contig, by tStart within each contig
+                # (file order among equal tStarts)
+                order = np.lexsort((self.tStart, self.RefGroupID))
+                self._rowsByRefGroup = (self.RefGroupID[order], order)
+            sortedRefGroupIds, order = self._rowsByRefGroup
+            rowNumbers = order[np.searchsorted(sortedRefGroupIds, refInfo.ID, side="left"):
+                               np.searchsorted(sortedRefGroupIds, refInfo.ID, side="right")]
+            rowNumbers = rowNumbers.astype(np.uint32)
+            columns = readLocatorColumns(rowNumbers,
+                                         self.tStart[rowNumbers],
+                                         self.tEnd[rowNumbers])
+        return columns
+
+    def _readLocator(self, refKey):
+        readLocator = self._readLocatorByKey.get(refKey)
+        if readLocator is None:
+            refInfo = self.referenceInfo(refKey)
+            readLocator = self._readLocatorByKey.get(refInfo.ID)
+            if readLocator is None:
+                readLocator = makeReadLocatorFromColumns(*self._readLocatorColumns(refInfo))
+                self._readLocatorByKey[refInfo.ID] = readLocator
+            self._readLocatorByKey[refKey] = readLocator
+        return readLocator
+
+    def writeReadLocatorCache(self, filename):
+        """
+        Save the arrays backing the read locators of all the contigs
+        to the sidecar file `filename`, for use as the
+        `readLocatorCache` of readers opened later on this file.
+        """
+        writeReadLocatorCache(filename, self.filename, len(self),
+                              ((refInfo.ID, self._readLocatorColumns(refInfo))
+                               for refInfo in self.referenceInfoTable
+                               if refInfo.ID != -1))
+
     def hasPulseFeature(self, featureName):
         """
         Are the datasets for pulse feature `featureName` loaded in
@@ -1147,6 +1380,283 @@ class CmpH5Reader(IndexedAlignmentReaderMixin):
         pulseFeaturesAvailableAsSet.discard("AlnArray")
         return list(pulseFeaturesAvailableAsSet)
 
+    def _fetchBatch(self, rowNumbers, datasetName):
+        """
+        Fetch the per-column dataset `datasetName` (``AlnArray`` or a
+        pulse feature) for many alignments, in native orientation,
+        with gaps.  Rows are grouped by alignment group and each
+        group's offset ranges are coalesced into as few HDF5 reads as
+        possible.  Returns ``(data, offsets)`` in CSR layout.
+        """
+        rowNumbers  = asRowNumbers(rowNumbers)
+        alnGroupIds = self.alignmentIndex.AlnGroupID[rowNumbers]
+        begins      = self.alignmentIndex.Offset_begin[rowNumbers]
+        ends        = self.alignmentIndex.Offset_end[rowNumbers]
+        offsets = np.zeros(len(rowNumbers) + 1, dtype=np.int64)
+        np.cumsum(ends - begins, out=offsets[1:])
+
+        if len(rowNumbers) == 0:
+            alnGroup = self._alignmentGroupById.values()[0]
+            return np.zeros(0, dtype=alnGroup[datasetName].dtype), offsets
+
+        data = None
+        for alnGroupId in np.unique(alnGroupIds):
+            sel = np.flatnonzero(alnGroupIds == alnGroupId)
+            ds = self._alignmentDataById[alnGroupId][datasetName]
+            groupData, _ = coalescedArrayFromDataset(ds, begins[sel], ends[sel])
+            if data is None:
+                data = np.empty(offsets[-1], dtype=groupData.dtype)
+            data[concatenatedRanges(offsets[sel], offsets[sel+1])] = groupData
+        return data, offsets
+
+    def _pileupColumns(self, rowNumbers):
+        # Alignment columns for all the rows, in genomic orientation
+        rowNumbers = asRowNumbers(rowNumbers)
+        alnArray, offsets = self._fetchBatch(rowNumbers, "AlnArray")
+        isReverse = self.alignmentIndex.RCRefStrand[rowNumbers] == 1
+        alnArray = alnArray[reversedSegmentsIndex(offsets, isReverse)]
+        lengths = np.diff(offsets)
+
+        refNonGapMask = (alnArray & 0b1111) != GAP
+        refPos = (np.repeat(self.alignmentIndex.tStart[rowNumbers].astype(np.int64), lengths) +
+                  segmentedExclusiveCumsum(refNonGapMask, offsets))
+        readBase = _pileupBaseIndex[np.repeat(isReverse, lengths).astype(int),
+                                    alnArray >> 4]
+        return refPos, readBase, ~refNonGapMask
+
+    def pulseFeatureBatch(self, rowNumbers, featureName,
+                          aligned=True, orientation="native"):
+        """
+        Access a pulse feature for many alignments at once.  This is
+        equivalent to calling `CmpH5Alignment.pulseFeature` on each of
+        the alignments at `rowNumbers`, but the data for all of them
+        is read with a handful of coalesced HDF5 reads.
+
+        The return value is a pair ``(data, offsets)``: the pulse
+        feature arrays for the alignments, concatenated in the order
+        requested, and an array of ``len(rowNumbers) + 1`` offsets
+        such that the feature for ``rowNumbers[i]`` is
+        ``data[offsets[i]:offsets[i+1]]``.
+
+        .. doctest::
+
+            >>> data, offsets = c.pulseFeatureBatch([26, 0], "IPD")
+            >>> offsets
+            array([  0, 286, 606])
+            >>> len(c[26].IPD()), len(c[0].IPD())
+            (286, 320)
+        """
+        if not (orientation == "native" or orientation == "genomic"):
+            raise ValueError, "Bad `orientation` value"
+        rowNumbers = asRowNumbers(rowNumbers)
+        data, offsets = self._fetchBatch(rowNumbers, featureName)
+        if orientation == "genomic":
+            isReverse = self.alignmentIndex.RCRefStrand[rowNumbers] == 1
+            data = data[reversedSegmentsIndex(offsets, isReverse)]
+        if not aligned:
+            data, offsets = compressedSegments(data, offsets,
+                                               pulseArrayNonGapMask(data))
+        return data, offsets
+
+    def decodeBatch(self, rowNumbers, what=("read", "reference", "transcript"),
+                    aligned=True, orientation="native", style="gusfield"):
+        """
+        Decode the alignments at `rowNumbers` all at once.  `what`
+        lists the sequences wanted, among ``"read"``, ``"reference"``
+        and ``"transcript"``; the return value is a dict mapping each
+        of them to a pair ``(data, offsets)``, where `data` is a flat
+        uint8 array of characters and the sequence for
+        ``rowNumbers[i]`` is ``data[offsets[i]:offsets[i+1]]``.
+
+        The read, reference and transcript for each alignment are the
+        same as given by `CmpH5Alignment.read`, `reference` and
+        `transcript` for the same `aligned`, `orientation` and
+        `style` arguments (the transcript always covers every
+        alignment column), but are decoded in a single table lookup
+        over alignment arrays fetched with coalesced reads.
+
+        .. doctest::
+
+            >>> decoded = c.decodeBatch([26, 0], what=["read"], aligned=False)
+            >>> data, offsets = decoded["read"]
+            >>> data[offsets[0]:offsets[1]].tostring() == c[26].read(aligned=False)
+            True
+        """
+        if not (orientation == "native" or orientation == "genomic"):
+            raise ValueError, "Bad `orientation` value"
+        rowNumbers = asRowNumbers(rowNumbers)
+        alnArray, offsets = self._fetchBatch(rowNumbers, "AlnArray")
+        if orientation == "genomic":
+            isReverse = self.alignmentIndex.RCRefStrand[rowNumbers] == 1
+            alnArray = alnArray[reversedSegmentsIndex(offsets, isReverse)]
+            complement = np.repeat(isReverse, np.diff(offsets)).astype(int)
+        else:
+            complement = 0
+
+        decoded = {}
+        for name in what:
+            if name == "transcript":
+                tbl = _transcriptDecodingTables.get(style, _transcriptDecodingTables["gusfield"])
+                decoded[name] = (tbl[alnArray], offsets)
+                continue
+            elif name == "read":
+                data = _readDecodingTable[complement, alnArray]
+            elif name == "reference":
+                data = _referenceDecodingTable[complement, alnArray]
+            else:
+                raise ValueError, "Cannot decode `%s`" % name
+            if aligned:
+                decoded[name] = (data, offsets)
+            else:
+                decoded[name] = compressedSegments(data, offsets, data != ord("-"))
+        return decoded
+
+    def clipToWindow(self, rowNumbers, refStart, refEnd):
+        """
+        Clip many alignments at once to the reference window
+        [`refStart`, `refEnd`), which each of them must overlap.
+
+        Returns a recarray with one record per row number, holding the
+        fields of the alignment index that clipping changes
+        (``tStart``, ``tEnd``, ``rStart``, ``rEnd``, ``Offset_begin``,
+        ``Offset_end``, ``nM``, ``nMM``, ``nIns``, ``nDel``), with the
+        same values as the corresponding fields of
+        ``c[rowNumber].clippedTo(refStart, refEnd)``.  The alignment
+        arrays are read with coalesced reads and the clip points and
+        move counts are computed in a single vectorized pass, without
+        creating an alignment object per row.
+
+        .. doctest::
+
+            >>> clipped = c.clipToWindow([0, 1], 100, 200)
+            >>> clipped.tStart, clipped.tEnd
+            (array([100, 100], dtype=uint32), array([200, 200], dtype=uint32))
+        """
+        rowNumbers = asRowNumbers(rowNumbers)
+        tStart = self.alignmentIndex.tStart[rowNumbers].astype(np.int64)
+        tEnd   = self.alignmentIndex.tEnd[rowNumbers].astype(np.int64)
+        if refStart >= refEnd or np.any((refStart >= tEnd) | (refEnd <= tStart)):
+            raise IndexError, "Clipping query does not overlap alignment"
+        clipRefStart = np.maximum(tStart, refStart)
+        clipRefEnd   = np.minimum(tEnd,   refEnd)
+
+        # Alignment columns, in genomic orientation
+        alnArray, offsets = self._fetchBatch(rowNumbers, "AlnArray")
+        isReverse = self.alignmentIndex.RCRefStrand[rowNumbers] == 1
+        alnArray = alnArray[reversedSegmentsIndex(offsets, isReverse)]
+        lengths = np.diff(offsets)
+        n = len(rowNumbers)
+        segment = np.repeat(np.arange(n), lengths)
+        column  = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+
+        # Clip points within each alignment, as in ClippedCmpH5Alignment:
+        #   clipStart = bisect_right(refPositions, clipRefStart) - 1
+        #   clipEnd   = bisect_left(refPositions, clipRefEnd)
+        refPos = (np.repeat(tStart, lengths) +
+                  segmentedExclusiveCumsum((alnArray & 0b1111) != GAP, offsets))
+        clipStart = np.bincount(segment[refPos <= np.repeat(clipRefStart, lengths)],
+                                minlength=n) - 1
+        clipEnd   = np.bincount(segment[refPos <  np.repeat(clipRefEnd, lengths)],
+                                minlength=n)
+
+        # Alignment moves within the clipped region
+        inClip = ((column >= np.repeat(clipStart, lengths)) &
+                  (column <  np.repeat(clipEnd,   lengths)))
+        clippedArray = alnArray[inClip]
+        moves = _gusfieldTranscriptTable[_baseEncodingToInt[clippedArray >> 4],
+                                         _baseEncodingToInt[clippedArray & 0b1111]]
+        nM, nMM, nIns, nDel = [ np.bincount(segment[inClip][moves == ord(move)],
+                                            minlength=n)
+                                for move in "MRID" ]
+
+        # Read bases preceding the clip start, in genomic orientation
+        readOffset = segmentedExclusiveCumsum((alnArray >> 4) != GAP, offsets)
+        readOffset = readOffset[offsets[:-1] + clipStart]
+        readLength = nM + nMM + nIns
+        rStart = self.alignmentIndex.rStart[rowNumbers].astype(np.int64)
+        rEnd   = self.alignmentIndex.rEnd[rowNumbers].astype(np.int64)
+        offsetBegin = self.alignmentIndex.Offset_begin[rowNumbers].astype(np.int64)
+        offsetEnd   = self.alignmentIndex.Offset_end[rowNumbers].astype(np.int64)
+
+        clipped = np.recarray(n, dtype=[ (name, np.uint32) for name in
+                                         ClippedCmpH5Alignment.__slots__ ])
+        clipped.tStart = clipRefStart
+        clipped.tEnd   = clipRefEnd
+        clipped.rStart = np.where(isReverse, rEnd - readOffset - readLength, rStart + readOffset)
+        clipped.rEnd   = np.where(isReverse, rEnd - readOffset, rStart + readOffset + readLength)
+        clipped.Offset_begin = np.where(isReverse, offsetEnd - clipEnd,   offsetBegin + clipStart)
+        clipped.Offset_end   = np.where(isReverse, offsetEnd - clipStart, offsetBegin + clipEnd)
+        clipped.nM   = nM
+        clipped.nMM  = nMM
+        clipped.nIns = nIns
+        clipped.nDel = nDel
+        return clipped
+
+    def kineticsMatrix(self, refKey, refStart, refEnd,
+                       features=("IPD", "PulseWidth"), strand=None):
+        """
+        Tabulate pulse features of the reads overlapping the
+        reference window [`refStart`, `refEnd`) by reference position.
+
+        Returns a `KineticsMatrix`, where `rowNumbers` are the rows of
+        the reads (restricted to the given `strand`, ``"+"`` or
+        ``"-"``, if any) and `features` maps each of the `features`
+        to a float32 masked array of shape ``(len(rowNumbers), refEnd
+        - refStart)``, holding at ``[i, j]`` the feature value of the
+        read base of ``rowNumbers[i]`` aligned to reference position
+        ``refStart + j``.  Positions not covered by the read, or
+        deleted in it, are masked; inserted bases are left out.  The
+        time-valued features (``IPD``, ``PulseWidth``) are multiplied
+        by the `TimeScale` of the read's movie.
+
+        The reads' alignment arrays and features are fetched with
+        coalesced reads and scattered into the matrices in a single
+        vectorized pass.
+        """
+        if strand not in (None, "+", "-"):
+            raise ValueError, "Bad `strand` value"
+        rowNumbers = self.readsInRange(refKey, refStart, refEnd, justIndices=True)
+        isReverse = self.alignmentIndex.RCRefStrand[rowNumbers] == 1
+        if strand is not None:
+            onStrand = isReverse if strand == "-" else ~isReverse
+            rowNumbers = rowNumbers[onStrand]
+            isReverse  = isReverse[onStrand]
+        n = len(rowNumbers)
+        width = refEnd - refStart
+
+        # Alignment columns, in genomic orientation
+        alnArray, offsets = self._fetchBatch(rowNumbers, "AlnArray")
+        genomicIx = reversedSegmentsIndex(offsets, isReverse)
+        alnArray = alnArray[genomicIx]
+        lengths = np.diff(offsets)
+        refNonGapMask = (alnArray & 0b1111) != GAP
+        column = (np.repeat(self.alignmentIndex.tStart[rowNumbers].astype(np.int64), lengths) +
+                  segmentedExclusiveCumsum(refNonGapMask, offsets) - refStart)
+        # Matches and mismatches within the window
+        keep = (refNonGapMask & ((alnArray >> 4) != GAP) &
+                (column >= 0) & (column < width))
+        row    = np.repeat(np.arange(n), lengths)[keep]
+        column = column[keep]
+
+        movieIds = self.movieInfoTable.ID
+        movieOrder = np.argsort(movieIds)
+        timeScale = self.movieInfoTable.TimeScale[
+            movieOrder[np.searchsorted(movieIds[movieOrder],
+                                       self.alignmentIndex.MovieID[rowNumbers])]]
+
+        matrices = {}
+        for featureName in features:
+            data, _ = self._fetchBatch(rowNumbers, featureName)
+            values = data[genomicIx][keep].astype(np.float32)
+            if featureName in ("IPD", "PulseWidth"):
+                values *= timeScale[row].astype(np.float32)
+            matrix = np.zeros((n, width), dtype=np.float32)
+            mask   = np.ones((n, width), dtype=bool)
+            matrix[row, column] = values
+            mask[row, column]   = False
+            matrices[featureName] = np.ma.masked_array(matrix, mask)
+        return KineticsMatrix(refStart, refEnd, rowNumbers, matrices)
+
     @property
     def barcode(self):
         """
@@ -1208,6 +1718,11 @@ class CmpH5Reader(IndexedAlignmentReaderMixin):
         if hasattr(self, "file") and self.file is not None:
             self.file.close()
             self.file = None
+            self._alignmentDataById = {}
+            self._fileMap.close()
+        if hasattr(self, "_readLocatorCache") and self._readLocatorCache is not None:
+            self._readLocatorCache.file.close()
+            self._readLocatorCache = None
 
     def __enter__(self):
         return self
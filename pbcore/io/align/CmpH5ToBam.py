@@ -0,0 +1,252 @@
+#################################################################################
+# Copyright (c) 2011-2015, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+__all__ = [ "cmpH5ToBam" ]
+
+from hashlib import md5
+import multiprocessing
+from pysam import Samfile, AlignedRead
+import pysam
+import numpy as np
+
+from pbcore import __VERSION__
+from pbcore.io.FastaIO import splitFastaHeader
+from pbcore.io._utils import compressedSegments
+from ._BamSupport import *
+from .CmpH5IO import CmpH5Reader
+from .PacBioBamIndex import writePacBioBamIndex
+
+# CIGAR op for each code of the "cigar" style transcript
+_cigarOpFromTranscript = np.zeros(256, dtype=int)
+_cigarOpFromTranscript[ord("M")] = BAM_CMATCH
+_cigarOpFromTranscript[ord("I")] = BAM_CINS
+_cigarOpFromTranscript[ord("D")] = BAM_CDEL
+
+
+def _readGroupId(movieName, readType):
+    return md5(movieName + "//" + readType).hexdigest()[:8]
+
+def _bamReadType(cmpH5):
+    return "CCS" if cmpH5.readType == "CCS" else "SUBREAD"
+
+def _bamReferences(cmpH5):
+    # The contigs of the cmp.h5, in the order of the SQ header lines,
+    # leaving out the placeholder reference (ID -1)
+    return [ ref for ref in cmpH5.referenceInfoTable if ref.ID != -1 ]
+
+def _bamHeader(cmpH5):
+    readType = _bamReadType(cmpH5)
+    pulseFeatures = [ f for f in sorted(PULSE_FEATURE_TAGS)
+                      if cmpH5.hasPulseFeature(f) ]
+    movieInfo = cmpH5.file["/MovieInfo"]
+    hasChemistry = all(k in movieInfo for k in
+                       ("BindingKit", "SequencingKit", "SoftwareVersion"))
+    readGroups = []
+    for i, movie in enumerate(cmpH5.movieInfoTable):
+        ds = [ "READTYPE=%s" % readType ]
+        ds += [ "%s=%s" % (f, PULSE_FEATURE_TAGS[f][0]) for f in pulseFeatures ]
+        if hasChemistry:
+            ds += [ "BINDINGKIT=%s"      % movieInfo["BindingKit"][i],
+                    "SEQUENCINGKIT=%s"   % movieInfo["SequencingKit"][i],
+                    "SOFTWAREVERSION=%s" % movieInfo["SoftwareVersion"][i] ]
+        readGroups.append({ "ID" : _readGroupId(movie.Name, readType),
+                            "PU" : movie.Name,
+                            "DS" : ";".join(ds) })
+    references = [ { "SN" : splitFastaHeader(ref.FullName)[0],
+                     "LN" : int(ref.Length),
+                     "M5" : ref.MD5 }
+                   for ref in _bamReferences(cmpH5) ]
+    return { "HD" : { "VN" : "1.3.1", "SO" : "coordinate" },
+             "SQ" : references,
+             "RG" : readGroups,
+             "PG" : [ { "ID" : "cmpH5ToBam",
+                        "VN" : __VERSION__,
+                        "CL" : "cmpH5ToBam %s" % cmpH5.filename } ] }
+
+
+def _encodeAlignments(cmpH5, rowNumbers):
+    """
+    Encode the alignments at `rowNumbers` as tuples of plain values
+    ``(qname, flag, pos, mapq, cigar, seq, qual, tags)``, ready to be
+    loaded into pysam records.  This is the work done in the worker
+    processes.
+    """
+    n = len(rowNumbers)
+    idx = cmpH5.alignmentIndex
+    isReverse = idx.RCRefStrand[rowNumbers] == 1
+    tStart = idx.tStart[rowNumbers]
+    rStart = idx.rStart[rowNumbers]
+    rEnd   = idx.rEnd[rowNumbers]
+    holeNumber = idx.HoleNumber[rowNumbers]
+    mapQV  = idx.MapQV[rowNumbers]
+    movieNames = [ cmpH5.movieInfo(movieId).Name for movieId in idx.MovieID[rowNumbers] ]
+    readType = _bamReadType(cmpH5)
+
+    # BAM records present the read, the CIGAR and the pulse features
+    # in genomic orientation
+    decoded = cmpH5.decodeBatch(rowNumbers, what=("read", "transcript"),
+                                orientation="genomic", style="cigar")
+    alignedRead, offsets = decoded["read"]
+    read, readOffsets = compressedSegments(alignedRead, offsets, alignedRead != ord("-"))
+
+    # Run-length encode the CIGAR ops of all the alignments at once
+    ops = _cigarOpFromTranscript[decoded["transcript"][0]]
+    isRunStart = np.ones(len(ops), dtype=bool)
+    isRunStart[1:] = ops[1:] != ops[:-1]
+    isRunStart[offsets[:-1]] = True
+    runStarts = np.flatnonzero(isRunStart)
+    runLengths = np.diff(np.append(runStarts, len(ops)))
+    runOps = ops[runStarts]
+    runOffsets = np.searchsorted(runStarts, offsets)
+
+    features = {}
+    for featureName in ["QualityValue"] + sorted(PULSE_FEATURE_TAGS):
+        if not cmpH5.hasPulseFeature(featureName):
+            continue
+        data, _ = cmpH5.pulseFeatureBatch(rowNumbers, featureName, aligned=False,
+                                          orientation="genomic")
+        if featureName == "DeletionTag":
+            complement = np.repeat(isReverse, np.diff(readOffsets))
+            data = np.where(complement, COMPLEMENT_ASCII[data.view(np.uint8)].view(np.int8), data)
+        else:
+            data = np.minimum(data, 93).astype(np.uint8) + 33
+        features[featureName] = data.astype(np.uint8).tostring()
+
+    encoded = []
+    for i in xrange(n):
+        s, e = readOffsets[i], readOffsets[i+1]
+        if readType == "CCS":
+            qname = "%s/%d/ccs" % (movieNames[i], holeNumber[i])
+        else:
+            qname = "%s/%d/%d_%d" % (movieNames[i], holeNumber[i], rStart[i], rEnd[i])
+        cigar = zip(runOps[runOffsets[i]:runOffsets[i+1]].tolist(),
+                    runLengths[runOffsets[i]:runOffsets[i+1]].tolist())
+        tags = [ ("RG", _readGroupId(movieNames[i], readType)),
+                 ("YS", int(rStart[i])),
+                 ("YE", int(rEnd[i])),
+                 ("ZM", int(holeNumber[i])) ]
+        tags += [ (PULSE_FEATURE_TAGS[f][0], features[f][s:e])
+                  for f in sorted(PULSE_FEATURE_TAGS) if f in features ]
+        encoded.append((qname,
+                        0x10 if isReverse[i] else 0,
+                        int(tStart[i]),
+                        int(mapQV[i]),
+                        cigar,
+                        read[s:e].tostring(),
+                        features["QualityValue"][s:e] if "QualityValue" in features else None,
+                        tags))
+    return encoded
+
+
+def cmpH5ToBam(cmpH5Filename, bamFilename, processes=None, chunkSize=1000):
+    """
+    Convert a cmp.h5 file to a coordinate-sorted BAM file, writing
+    along with it the BAM index (``.bai``) and the PacBio BAM index
+    (``.pbi``), so that the result can be opened with
+    `IndexedBamReader`.
+
+    The alignments are streamed to the BAM file in reference order.
+    They are encoded---CIGAR, read sequence and pulse feature tags
+    (as named in `PULSE_FEATURE_TAGS`)---in chunks of `chunkSize`
+    rows by a pool of `processes` worker processes (see
+    `parallelMap`), while this process writes the records and
+    gathers the ``.pbi`` columns from the cmp.h5 alignment index.
+    At most two encoded chunks per worker are held waiting for the
+    writer.
+
+    The read groups of the BAM file record the chemistry information
+    of the cmp.h5 movies, where present.
+    """
+    cmpH5 = CmpH5Reader(cmpH5Filename)
+    header = _bamHeader(cmpH5)
+
+    # BAM target IDs follow the order of the SQ header lines
+    tidByRefGroupId = { ref.ID : tid for (tid, ref) in
+                        enumerate(_bamReferences(cmpH5)) }
+    tIds = np.array([ tidByRefGroupId[refId] for refId in cmpH5.RefGroupID ],
+                    dtype=np.uint32)
+    rowOrder = np.lexsort((cmpH5.tStart, tIds))
+    chunks = [ rowOrder[i:i+chunkSize] for i in xrange(0, len(rowOrder), chunkSize) ]
+
+    bam = Samfile(bamFilename, "wb", header=header)
+    try:
+        i = 0
+        maxPending = 2 * (processes or multiprocessing.cpu_count())
+        for encoded in cmpH5.parallelMap(_encodeAlignments, chunks, processes=processes,
+                                         maxPending=maxPending):
+            for (qname, flag, pos, mapq, cigar, seq, qual, tags) in encoded:
+                a = AlignedRead()
+                a.qname = qname
+                a.flag  = flag
+                a.tid   = tIds[rowOrder[i]]
+                a.pos   = pos
+                a.mapq  = mapq
+                a.cigar = cigar
+                a.seq   = seq
+                a.qual  = qual
+                a.tags  = tags
+                bam.write(a)
+                i += 1
+    finally:
+        bam.close()
+    pysam.index(bamFilename)
+
+    # pysam cannot report the virtual file offset while writing, so
+    # the offsets for the .pbi are collected by reading the records
+    # back
+    virtualFileOffsets = np.zeros(len(rowOrder), dtype=np.uint64)
+    bam = Samfile(bamFilename, "rb")
+    try:
+        for i in xrange(len(rowOrder)):
+            virtualFileOffsets[i] = bam.tell()
+            next(bam)
+    finally:
+        bam.close()
+
+    idx = cmpH5.alignmentIndex
+    readGroupIds = { movie.ID : int(_readGroupId(movie.Name, _bamReadType(cmpH5)), 16)
+                     for movie in cmpH5.movieInfoTable }
+    writePacBioBamIndex(bamFilename + ".pbi",
+                        { "HoleNumber"        : idx.HoleNumber[rowOrder],
+                          "MapQV"             : idx.MapQV[rowOrder],
+                          "ReadGroupID"       : [ readGroupIds[movieId] for movieId
+                                                  in idx.MovieID[rowOrder] ],
+                          "isReverseStrand"   : idx.RCRefStrand[rowOrder],
+                          "nDel"              : idx.nDel[rowOrder],
+                          "nIns"              : idx.nIns[rowOrder],
+                          "nM"                : idx.nM[rowOrder],
+                          "nMM"               : idx.nMM[rowOrder],
+                          "rEnd"              : idx.rEnd[rowOrder],
+                          "rStart"            : idx.rStart[rowOrder],
+                          "tEnd"              : idx.tEnd[rowOrder],
+                          "tId"               : tIds[rowOrder],
+                          "tStart"            : idx.tStart[rowOrder],
+                          "virtualFileOffset" : virtualFileOffsets })
+    cmpH5.close()
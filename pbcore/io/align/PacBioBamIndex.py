@@ -36,6 +36,40 @@ from os.path import abspath, expanduser
 from functools import wraps
 from collections import namedtuple
 
+from pbcore.io.rangeQueries import (readLocatorColumns, makeReadLocatorFromColumns,
+                                    writeReadLocatorCache, openReadLocatorCache,
+                                    readLocatorColumnsFromCache)
+
+# Columns of the per-record table, and their types
+PBI_COLUMNS_AND_TYPES = [ ("HoleNumber",        np.uint32),
+                          ("MapQV",             np.uint8),
+                          ("ReadGroupID",       np.uint32),
+                          ("isReverseStrand",   np.uint8),
+                          ("nDel",              np.uint32),
+                          ("nIns",              np.uint32),
+                          ("nM",                np.uint32),
+                          ("nMM",               np.uint32),
+                          ("rEnd",              np.uint32),
+                          ("rStart",            np.uint32),
+                          ("tEnd",              np.uint32),
+                          ("tId",               np.uint32),
+                          ("tStart",            np.uint32),
+                          ("virtualFileOffset", np.uint64) ]
+
+def writePacBioBamIndex(pbiFilename, columns):
+    """
+    Write a bam.pbi file, given a dict mapping each of the column
+    names in PBI_COLUMNS_AND_TYPES to an array with an entry per BAM
+    record, in file order.
+    """
+    with h5py.File(pbiFilename, "w") as f:
+        g = f.create_group("PacBioBamIndex")
+        g.attrs["Version"] = "0.1"
+        cg = g.create_group("Columns")
+        for (columnName, dtype) in PBI_COLUMNS_AND_TYPES:
+            cg.create_dataset(columnName, data=np.asarray(columns[columnName], dtype=dtype),
+                              compression="gzip")
+
 class PacBioBamIndex(object):
     """
     The PacBio BAM index is a companion file allowing modest
@@ -51,12 +85,26 @@ class PacBioBamIndex(object):
 
       - A table with a row per reference contig (tid) in the BAM,
         indicating the range of rows pertaining to the
+
+    Range queries are served by a read locator per contig, as for
+    cmp.h5 files: the contig's rows are put in order of tStart, with
+    the `nBackRead` back-off computed for each, so that a query is a
+    binary search plus a scan of the overlapping rows.  The locator
+    for a contig is built on its first query; the arrays backing the
+    locators can be saved to a sidecar file with
+    `writeReadLocatorCache`, and loaded from it by passing
+    ``readLocatorCache=<sidecar filename>`` when opening the index.  A
+    sidecar made for a different (or since modified) index file is
+    ignored.
+
+    Columns are read from the file the first time they are used; the
+    file is kept open until the index is closed (as it is when the
+    `IndexedBamReader` is closed) or garbage collected.
     """
-    def _loadColumns(self, f):
-        g = f["PacBioBamIndex/Columns"]
-        columnNamesAndColumns = sorted([ (k, v[:]) for (k, v) in g.iteritems() ])
-        columnNames, columns = zip(*columnNamesAndColumns)
-        return np.rec.fromarrays(columns, names=columnNames)
+    ITER_CHUNK_SIZE = 4096
+
+    def _loadColumnDatasets(self, f):
+        return dict(f["PacBioBamIndex/Columns"].items())
 
     def _loadVersion(self, f):
         return f["PacBioBamIndex"].attrs["Version"]
@@ -64,12 +112,23 @@ class PacBioBamIndex(object):
     def _loadOffsets(self, f):
         pass
 
-    def __init__(self, pbiFilename):
-        pbiFilename = abspath(expanduser(pbiFilename))
-        with h5py.File(pbiFilename, "r") as f:
-            self._version = self._loadVersion(f)
-            self._columns = self._loadColumns(f)
-            self._offsets = self._loadOffsets(f)
+    def __init__(self, pbiFilename, readLocatorCache=None):
+        self.filename = pbiFilename = abspath(expanduser(pbiFilename))
+        # The file is kept open; columns are read from it on first
+        # access
+        self._file = h5py.File(pbiFilename, "r")
+        self._version = self._loadVersion(self._file)
+        self._columnDatasets = self._loadColumnDatasets(self._file)
+        self._length = len(self._columnDatasets.values()[0])
+        self._columns = {}
+        self._offsets = self._loadOffsets(self._file)
+        self._readLocatorByTId = {}
+        self._rowsByTId = None
+        if readLocatorCache is not None:
+            self._readLocatorCache = openReadLocatorCache(readLocatorCache,
+                                                          self.filename, len(self))
+        else:
+            self._readLocatorCache = None
 
     @property
     def version(self):
@@ -77,27 +136,121 @@ class PacBioBamIndex(object):
 
     @property
     def columnNames(self):
-        return list(self._columns.dtype.names)
+        return sorted(self._columnDatasets.keys())
+
+    def column(self, columnName):
+        """
+        The column `columnName`, as a numpy array, read from the file
+        the first time it is asked for.
+        """
+        column = self._columns.get(columnName)
+        if column is None:
+            column = self._columnDatasets[columnName][:]
+            self._columns[columnName] = column
+        return column
+
+    def _columnRows(self, columnName, key):
+        # Rows `key` (a row number or a slice) of a column, read
+        # straight from the file unless the column is already loaded
+        column = self._columns.get(columnName)
+        if column is not None:
+            return column[key]
+        elif isinstance(key, slice) and key.step in (None, 1):
+            start, stop, _ = key.indices(len(self))
+            return self._columnDatasets[columnName][start:max(start, stop)]
+        elif isinstance(key, slice):
+            return self.column(columnName)[key]
+        else:
+            return self._columnDatasets[columnName][key]
 
     def __getattr__(self, columnName):
-        if columnName in self.columnNames:
-            return self._columns[columnName]
+        if not columnName.startswith("_") and columnName in self._columnDatasets:
+            return self.column(columnName)
         else:
             raise AttributeError, "pbi has no column named '%s'" % columnName
 
-    def __getitem__(self, rowNumber):
-        return self._columns[rowNumber]
+    def __getitem__(self, key):
+        """
+        ``pbi[columnName]`` is the column; ``pbi[i]`` is a numpy
+        record holding row `i`; indexing with a slice or row numbers
+        yields a recarray of the rows.  Rows and slices of columns not
+        yet loaded are read from the file without loading the columns.
+        """
+        if isinstance(key, basestring):
+            return self.column(key)
+        elif isinstance(key, (int, long, np.integer)):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError, "pbi row number out of range"
+            columnNames = self.columnNames
+            row = np.recarray(1, dtype=[ (c, self._columnDatasets[c].dtype)
+                                         for c in columnNames ])
+            for c in columnNames:
+                row[c] = self._columnRows(c, key)
+            return row[0]
+        elif isinstance(key, slice):
+            columnNames = self.columnNames
+            return np.rec.fromarrays([ self._columnRows(c, key) for c in columnNames ],
+                                     names=columnNames)
+        else:
+            columnNames = self.columnNames
+            return np.rec.fromarrays([ self.column(c)[key] for c in columnNames ],
+                                     names=columnNames)
 
     def __dir__(self):
         # Special magic for IPython tab completion
         return self.columnNames
 
     def __len__(self):
-        return len(self._columns)
+        return self._length
 
     def __iter__(self):
-        for i in xrange(len(self)):
-            yield self[i]
+        # Rows are read a chunk of ITER_CHUNK_SIZE at a time
+        for start in xrange(0, len(self), self.ITER_CHUNK_SIZE):
+            for row in self[start:start + self.ITER_CHUNK_SIZE]:
+                yield row
+
+    def _readLocatorColumns(self, tId):
+        columns = readLocatorColumnsFromCache(self._readLocatorCache, tId)
+        if columns is None:
+            if self._rowsByTId is None:
+                # Rows grouped by tId, in file order within each group
+                order = np.argsort(self.tId, kind="mergesort")
+                self._rowsByTId = (self.tId[order], order)
+            sortedTIds, order = self._rowsByTId
+            rows = order[np.searchsorted(sortedTIds, tId, side="left"):
+                         np.searchsorted(sortedTIds, tId, side="right")]
+            columns = readLocatorColumns(rows, self.tStart[rows], self.tEnd[rows])
+        return columns
+
+    def _readLocator(self, tId):
+        readLocator = self._readLocatorByTId.get(tId)
+        if readLocator is None:
+            readLocator = makeReadLocatorFromColumns(*self._readLocatorColumns(tId))
+            self._readLocatorByTId[tId] = readLocator
+        return readLocator
+
+    def writeReadLocatorCache(self, filename):
+        """
+        Save the arrays backing the read locators of all the contigs
+        having records to the sidecar file `filename`, for use as the
+        `readLocatorCache` of indexes opened later on this file.
+        """
+        writeReadLocatorCache(filename, self.filename, len(self),
+                              ((tId, self._readLocatorColumns(tId))
+                               for tId in np.unique(self.tId)))
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if getattr(self, "_file", None) is not None:
+            self._file.close()
+            self._file = None
+        if getattr(self, "_readLocatorCache", None) is not None:
+            self._readLocatorCache.file.close()
+            self._readLocatorCache = None
 
     def rangeQuery(self, winId, winStart, winEnd):
         #
@@ -105,13 +258,12 @@ class PacBioBamIndex(object):
         #
         #  (tStart < winEnd) && (tEnd > winStart)     (1)
         #
-        # We are presently doing this naively right now, just
-        # computing the predicate over all rows. If/when we determine
-        # this is too slow, we can accelerate using the nBackread
-        # approach we use int he cmph5, doing binary search to
-        # identify a candidate range and then culling the range.
+        # The contig's read locator finds the candidate rows by
+        # binary search on tStart, backing off by nBackRead, and culls
+        # them by tEnd.  Rows are returned in file order.
         #
-        ix = np.flatnonzero((self.tId    == winId)  &
-                            (self.tStart  < winEnd) &
-                            (self.tEnd    > winStart))
-        return ix
+        if winEnd <= winStart:
+            return np.flatnonzero((self.tId    == winId)  &
+                                  (self.tStart  < winEnd) &
+                                  (self.tEnd    > winStart))
+        return np.sort(self._readLocator(winId)(winStart, winEnd))
@@ -0,0 +1,163 @@
+#################################################################################
+# Copyright (c) 2011-2015, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+__all__ = [ "buildPacBioBamIndex" ]
+
+import multiprocessing
+from pysam import Samfile
+import numpy as np
+
+from ._BamSupport import *
+from ._BgzfSupport import recordsInRange, splitRecordRanges
+from .PacBioBamIndex import PBI_COLUMNS_AND_TYPES, writePacBioBamIndex
+
+def _optOrDefault(read, tag, default):
+    try:
+        return read.opt(tag)
+    except KeyError:
+        return default
+
+def _indexRecordRange(task):
+    """
+    Collect the bam.pbi columns for the mapped records of the BAM file
+    starting between the virtual file offsets `begin` and `end` (see
+    `splitRecordRanges`).
+    """
+    bamFilename, begin, end = task
+    bam = Samfile(bamFilename, "rb")
+    try:
+        records = []
+        cigarOps, cigarLengths, cigarRecords = [], [], []
+        for (offset, read) in recordsInRange(bam, begin, end):
+            if not read.is_unmapped:
+                i = len(records)
+                qStart = _optOrDefault(read, "YS", 0)
+                qEnd   = _optOrDefault(read, "YE", read.rlen)
+                if read.is_reverse:
+                    clipLeft, clipRight = read.rlen - read.qend, read.qstart
+                else:
+                    clipLeft, clipRight = read.qstart, read.rlen - read.qend
+                records.append((offset, read.tid, read.pos, read.aend,
+                                read.is_reverse, read.mapq,
+                                _optOrDefault(read, "ZM", 0),
+                                int(_optOrDefault(read, "RG", "0")[:8], 16),
+                                qStart + clipLeft, qEnd - clipRight,
+                                _optOrDefault(read, "NM", -1)))
+                for (op, length) in read.cigar:
+                    cigarOps.append(op)
+                    cigarLengths.append(length)
+                    cigarRecords.append(i)
+    finally:
+        bam.close()
+    if not records:
+        return None
+
+    (virtualFileOffset, tId, tStart, tEnd, isReverseStrand, mapQV,
+     holeNumber, readGroupId, rStart, rEnd, editDistance) = \
+        [ np.array(c) for c in zip(*records) ]
+    # Bases per CIGAR op, for each record
+    nOps = BAM_CDIFF + 1
+    opLengths = np.bincount(np.array(cigarRecords, dtype=int) * nOps +
+                            np.array(cigarOps, dtype=int),
+                            weights=cigarLengths,
+                            minlength=len(records) * nOps
+                            ).reshape(len(records), nOps).astype(np.int64)
+    nIns = opLengths[:, BAM_CINS]
+    nDel = opLengths[:, BAM_CDEL]
+    # With "="/"X" ops the matches and mismatches are explicit;
+    # otherwise mismatches are what the NM tag counts beyond the indels
+    hasExplicitMatches = (opLengths[:, BAM_CEQUAL] + opLengths[:, BAM_CDIFF]) > 0
+    underivable = np.flatnonzero(~hasExplicitMatches & (editDistance < 0))
+    if len(underivable):
+        raise ValueError("%s: record at virtual file offset %d has neither "
+                         "\"=\"/\"X\" CIGAR ops nor an NM tag; cannot "
+                         "count its matches and mismatches" %
+                         (bamFilename, virtualFileOffset[underivable[0]]))
+    nMM = np.where(hasExplicitMatches,
+                   opLengths[:, BAM_CDIFF],
+                   np.maximum(editDistance - nIns - nDel, 0))
+    nM  = np.where(hasExplicitMatches,
+                   opLengths[:, BAM_CEQUAL],
+                   opLengths[:, BAM_CMATCH] - nMM)
+    return { "HoleNumber"        : holeNumber,
+             "MapQV"             : mapQV,
+             "ReadGroupID"       : readGroupId,
+             "isReverseStrand"   : isReverseStrand,
+             "nDel"              : nDel,
+             "nIns"              : nIns,
+             "nM"                : nM,
+             "nMM"               : nMM,
+             "rEnd"              : rEnd,
+             "rStart"            : rStart,
+             "tEnd"              : tEnd,
+             "tId"               : tId,
+             "tStart"            : tStart,
+             "virtualFileOffset" : virtualFileOffset }
+
+
+def buildPacBioBamIndex(bamFilename, pbiFilename=None, processes=None):
+    """
+    Write a bam.pbi index (to `pbiFilename`, by default the BAM
+    filename with ".pbi" appended) for a BAM file lacking one,
+    indexing its mapped records in file order.
+
+    The records are cut into ranges, one per worker process (default:
+    one per CPU), at record starts listed in the BAM file's .bai
+    index; without a .bai the file is indexed in a single pass.
+    Returns the name of the index file.
+
+    The nM and nMM columns come from the "="/"X" CIGAR ops, or, for
+    records using "M" ops, from the NM tag; a ValueError is raised
+    for a mapped record having neither.
+    """
+    if pbiFilename is None:
+        pbiFilename = bamFilename + ".pbi"
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    tasks = [ (bamFilename, begin, end)
+              for (begin, end) in splitRecordRanges(bamFilename, processes) ]
+    if len(tasks) == 1:
+        results = map(_indexRecordRange, tasks)
+    else:
+        pool = multiprocessing.Pool(len(tasks))
+        try:
+            results = pool.map(_indexRecordRange, tasks)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    results = [ r for r in results if r is not None ]
+    columns = {}
+    for (columnName, _) in PBI_COLUMNS_AND_TYPES:
+        columns[columnName] = (np.concatenate([ r[columnName] for r in results ])
+                               if results else [])
+    writePacBioBamIndex(pbiFilename, columns)
+    return pbiFilename
@@ -32,11 +32,72 @@
 
 __all__ = [ "AlignmentReaderMixin",
             "AlignmentRecordMixin",
-            "IndexedAlignmentReaderMixin" ]
+            "IndexedAlignmentReaderMixin",
+            "AlignmentBatch",
+            "AlignmentFilter" ]
 
 from pbcore.io import BasH5Collection
+from pbcore.io._utils import asRowNumbers, concatenatedRanges
+from collections import deque, namedtuple
+import multiprocessing, operator
+import h5py
 import numpy as np
 
+# Column order of the base counts in a `Pileup`; the last column
+# counts deletions.
+PILEUP_BASES = "ACGTN-"
+
+Pileup = namedtuple("Pileup", ["refStart", "refEnd",
+                               "baseCounts", "insertionCounts"])
+
+# Each worker process of parallelMap opens its own reader, as h5py
+# and pysam file handles cannot be safely used across a fork.
+_workerReader = None
+
+def _closeInheritedH5Files():
+    # HDF5 hands a reopened file the already-open file it finds for
+    # the same inode, and the descriptors inherited across the fork
+    # share their file position with the parent and the other
+    # workers.  Closing the worker's copies (with all the datasets
+    # still open in them) does not affect the parent; files open for
+    # writing are left alone, as closing them here would flush this
+    # process's stale metadata.
+    for fileId in h5py.h5f.get_obj_ids(types=h5py.h5f.OBJ_FILE):
+        if fileId.valid and fileId.get_intent() == h5py.h5f.ACC_RDONLY:
+            h5py.File(fileId).close()
+
+# Kinds of read range part of a readsByName query
+_ANY_READ_QUERY, _CCS_QUERY, _READ_RANGE_QUERY = range(3)
+
+def _readGroupHoleKey(readGroupId, holeNumber):
+    # Pack (read group, hole number) into a single sortable integer;
+    # read group IDs may be negative 32-bit hashes
+    readGroupId = np.asarray(readGroupId).astype(np.int64) & 0xFFFFFFFF
+    return ((readGroupId.astype(np.uint64) << np.uint64(32)) |
+            np.asarray(holeNumber).astype(np.uint64))
+
+def _openWorkerReader(readerClass, constructorArgs):
+    global _workerReader
+    _closeInheritedH5Files()
+    _workerReader = readerClass(*constructorArgs)
+
+def _applyInWorker(task):
+    fn, arg = task
+    return fn(_workerReader, arg)
+
+def _boundedImap(pool, tasks, maxPending):
+    # Like pool.imap(_applyInWorker, tasks), but submitting a task
+    # only when fewer than `maxPending` results are waiting to be
+    # consumed
+    pending = deque()
+    for task in tasks:
+        if len(pending) >= maxPending:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(_applyInWorker, (task,)))
+    while pending:
+        yield pending.popleft().get()
+
+
 class AlignmentReaderMixin(object):
     """
     Mixin class for higher-level functionality of alignment file
@@ -67,41 +128,359 @@ class IndexedAlignmentReaderMixin(AlignmentReaderMixin):
          - "movieName/holeNumber/rStart_rEnd => gets all records *overlapping* read range query in movie, ZMW
          - "movieName/holeNumber/ccs"        => gets CCS records from chose movie, ZMW (zero or one)
 
+        The read range is matched against the aligned extent of each
+        record (``rStart_rEnd``, as given in its `readName`), not the
+        extent of the subread it was aligned from: a range overlapping
+        only the unaligned ends of a subread matches nothing.
+
         Records are returned in a list in ascending order of rStart
         """
-        def rgIDs(movieName):
-            return self.readGroupTable.ID[self.readGroupTable.MovieName == movieName]
-            #return self.movieInfoTable.ID[self.movieInfoTable.Name == movieName]
+        return self.readsByNames([query])[0]
 
-        def rangeOverlap(w1, w2):
-            s1, e1 = w1
-            s2, e2 = w2
-            return (e1 > s2) and (e2 > s1)
+    def readsByNames(self, queries):
+        """
+        Resolve many name queries (as accepted by `readsByName`) at
+        once, returning a list holding, for each query, the list of
+        records it identifies, in ascending order of rStart.
 
-        def rQueryMatch(readName, rQuery):
+        The queries are looked up in an index of the alignment rows by
+        (read group, hole number), built on first use with a single
+        sort of the alignment index; the records matching the read
+        range part of the queries are then selected using the
+        alignment index columns, without creating a record for every
+        candidate.
+        """
+        sortedKeys, order = self._readGroupHoleIndex()
+        rgIdsByMovie = {}
+        queryIds, keys = [], []
+        # The kind of read range part of each query, and its bounds
+        queryKinds, qStarts, qEnds = [], [], []
+        for (i, query) in enumerate(queries):
+            fields = query.split("/")
+            movieName = fields[0]
+            holeNumber = int(fields[1])
+            if len(fields) > 2: rQuery = fields[2]
+            else:               rQuery = "*"
             if rQuery == "*" or rQuery == "":
-                return True
+                queryKinds.append(_ANY_READ_QUERY)
+                qStarts.append(0); qEnds.append(0)
             elif rQuery == "ccs":
-                return readName.endswith("ccs")
-            elif readName.endswith("ccs"):
-                return False
+                queryKinds.append(_CCS_QUERY)
+                qStarts.append(0); qEnds.append(0)
             else:
-                q = map(int, rQuery.split("_"))
-                r = map(int, readName.split("/")[-1].split("_"))
-                return rangeOverlap(q, r)
+                qStart, qEnd = map(int, rQuery.split("_"))
+                queryKinds.append(_READ_RANGE_QUERY)
+                qStarts.append(qStart); qEnds.append(qEnd)
+            if movieName not in rgIdsByMovie:
+                rgIdsByMovie[movieName] = \
+                    self.readGroupTable.ID[self.readGroupTable.MovieName == movieName]
+            for rgId in rgIdsByMovie[movieName]:
+                queryIds.append(i)
+                keys.append(_readGroupHoleKey(rgId, holeNumber))
+
+        # The rows under each (query, read group) key
+        keys = np.array(keys, dtype=np.uint64)
+        begins = np.searchsorted(sortedKeys, keys, side="left")
+        ends   = np.searchsorted(sortedKeys, keys, side="right")
+        rowNumbers = order[concatenatedRanges(begins, ends)]
+        rowQueryIds = np.repeat(np.array(queryIds, dtype=int), ends - begins)
+
+        # Match the read range part of the queries, expanded to the
+        # candidate rows
+        rStart = self.rStart[rowNumbers]
+        rEnd   = self.rEnd[rowNumbers]
+        ccsReadGroupIds = self.readGroupTable.ID[self.readGroupTable.ReadType == "CCS"]
+        isCCS = np.in1d(self.ReadGroupID[rowNumbers], ccsReadGroupIds)
+        rowKind   = np.array(queryKinds, dtype=int)[rowQueryIds]
+        rowQStart = np.array(qStarts, dtype=np.int64)[rowQueryIds]
+        rowQEnd   = np.array(qEnds,   dtype=np.int64)[rowQueryIds]
+        keep = ((rowKind == _ANY_READ_QUERY) |
+                ((rowKind == _CCS_QUERY) & isCCS) |
+                ((rowKind == _READ_RANGE_QUERY) & ~isCCS &
+                 (rEnd > rowQStart) & (rStart < rowQEnd)))
+
+        # Order by query, then rStart, then row number
+        ix = np.flatnonzero(keep)
+        ix = ix[np.lexsort((rowNumbers[ix], rStart[ix], rowQueryIds[ix]))]
+        alns = self[rowNumbers[ix]] if len(ix) else []
+        counts = np.bincount(rowQueryIds[ix], minlength=len(queryKinds))
+        offsets = np.append(0, np.cumsum(counts))
+        return [ list(alns[offsets[i]:offsets[i+1]]) for i in xrange(len(queryKinds)) ]
+
+    def _readGroupHoleIndex(self):
+        # The (read group, hole number) keys of the alignment rows, in
+        # sorted order, and the row numbers in that order
+        if self._readGroupHoleIndexArrays is None:
+            keys = _readGroupHoleKey(self.ReadGroupID, self.HoleNumber)
+            order = np.argsort(keys, kind="mergesort")
+            self._readGroupHoleIndexArrays = (keys[order], order)
+        return self._readGroupHoleIndexArrays
+
+    def batch(self, rowNumbers):
+        """
+        Return an `AlignmentBatch`, a columnar view of the alignments
+        at the given row numbers (list or array of row numbers, or
+        boolean mask).
+        """
+        return AlignmentBatch(self, rowNumbers)
 
-        fields = query.split("/")
-        movieName = fields[0]
-        holeNumber = int(fields[1])
-        if len(fields) > 2: rQuery = fields[2]
-        else:               rQuery = "*"
+    def referenceWindows(self, windowSize):
+        """
+        Tile the reference contigs with windows of (at most)
+        `windowSize` bases, returning a list of ``(refId, start,
+        end)`` tuples.  The placeholder reference (ID -1) is skipped.
+        """
+        return [ (ref.ID, start, min(start + windowSize, ref.Length))
+                 for ref in self.referenceInfoTable
+                 if ref.ID != -1
+                 for start in xrange(0, ref.Length, windowSize) ]
+
+    def parallelMap(self, fn, windows=None, windowSize=100000, processes=None,
+                    maxPending=None):
+        """
+        Compute ``fn(reader, window)`` for each reference window,
+        distributing the work over `processes` worker processes
+        (default: one per CPU), and yield the results in window order
+        as they become available.
+
+        Windows are ``(refId, start, end)`` tuples; by default the
+        contigs in the `referenceInfoTable` are tiled with windows of
+        `windowSize` bases.  Each worker reopens the alignment file
+        and passes its own reader to `fn`, which must therefore be
+        picklable (i.e., a module-level function).  With
+        ``processes=1``, `fn` is simply applied in this process, with
+        this reader.
+
+        By default all the windows are handed to the pool up front, so
+        results pile up in this process if they are consumed more
+        slowly than they are computed; with `maxPending`, a window is
+        submitted only when fewer than `maxPending` results are
+        waiting.
+        """
+        if windows is None:
+            windows = self.referenceWindows(windowSize)
+        if processes == 1:
+            for window in windows:
+                yield fn(self, window)
+            return
+        pool = multiprocessing.Pool(processes, _openWorkerReader,
+                                    (type(self), self._constructorArgs()))
+        tasks = ((fn, w) for w in windows)
+        if maxPending is None:
+            results = pool.imap(_applyInWorker, tasks)
+        else:
+            results = _boundedImap(pool, tasks, maxPending)
+        try:
+            for result in results:
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def pileup(self, refKey, refStart, refEnd):
+        """
+        Tabulate the read bases aligned to each position of the
+        reference window [refStart, refEnd), using all the reads
+        overlapping the window.
 
-        rgs = rgIDs(movieName)
-        rns = np.flatnonzero(np.in1d(self.ReadGroupID, rgs) &
-                             (self.HoleNumber == holeNumber))
-        alns = [ a for a in self[rns]
-                 if rQueryMatch(a.readName, rQuery) ]
-        return sorted(alns, key=lambda a: a.readStart)
+        Returns a `Pileup`, where `baseCounts` is an array of shape
+        ``(refEnd - refStart, 6)`` holding, for each reference
+        position, the number of reads presenting an A, C, G, T, N or
+        deletion there (columns in the order of `PILEUP_BASES`), and
+        `insertionCounts` is an array of shape ``(refEnd - refStart,
+        5)`` holding the number of inserted A, C, G, T, N bases
+        immediately preceding each reference position.  Bases are
+        counted in genomic orientation.
+
+        All alignments are decoded and tabulated in a single
+        vectorized pass.
+        """
+        rowNumbers = self.readsInRange(refKey, refStart, refEnd, justIndices=True)
+        refPos, readBase, isInsertion = self._pileupColumns(rowNumbers)
+
+        width = refEnd - refStart
+        column = refPos - refStart
+        inWindow = (refPos >= refStart) & (refPos < refEnd)
+        nBases = len(PILEUP_BASES)
+
+        aligned = inWindow & ~isInsertion
+        baseCounts = np.bincount(column[aligned] * nBases + readBase[aligned],
+                                 minlength=width * nBases)
+        inserted = inWindow & isInsertion
+        insertionCounts = np.bincount(column[inserted] * nBases + readBase[inserted],
+                                      minlength=width * nBases)
+        return Pileup(refStart, refEnd,
+                      baseCounts.reshape(width, nBases).astype(np.uint32),
+                      insertionCounts.reshape(width, nBases)[:, :-1].astype(np.uint32))
+
+
+class AlignmentBatch(object):
+    """
+    A columnar view of a set of alignments in an indexed alignment
+    file, as returned by `batch`.
+
+    Each column of the alignment index (e.g. ``b.MapQV``, ``b.tStart``)
+    is available as a numpy array holding the values for the
+    alignments in the batch, in order; columns are sliced out of the
+    index on first access and kept.  The derived quantities
+    `accuracy`, `readLength`, `referenceSpan` and strand are likewise
+    computed as arrays, so that filters and summaries over many
+    alignments need no per-alignment objects.  Indexing the batch
+    with an integer yields the alignment record; indexing with a
+    slice, row selection or boolean mask yields a smaller batch::
+
+        b = reader.batch(reader.readsInRange(refId, start, end, justIndices=True))
+        good = b[(b.MapQV >= 10) & (b.accuracy > 0.8)]
+
+    Iterating over a batch creates the alignment records one by one.
+    """
+    def __init__(self, reader, rowNumbers):
+        self.reader = reader
+        self.rowNumbers = asRowNumbers(rowNumbers)
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.rowNumbers)
+
+    def column(self, columnName):
+        column = self._columns.get(columnName)
+        if column is None:
+            column = getattr(self.reader, columnName)[self.rowNumbers]
+            self._columns[columnName] = column
+        return column
+
+    def __getattr__(self, key):
+        if key.startswith("_"):
+            raise AttributeError(key)
+        try:
+            return self.column(key)
+        except (KeyError, ValueError):
+            raise AttributeError("no such column in alignment index: %s" % key)
+
+    @property
+    def isReverseStrand(self):
+        return self.column("isReverseStrand") != 0
+
+    @property
+    def isForwardStrand(self):
+        return ~self.isReverseStrand
+
+    @property
+    def readLength(self):
+        return self.rEnd.astype(np.int64) - self.rStart
+
+    @property
+    def referenceSpan(self):
+        return self.tEnd.astype(np.int64) - self.tStart
+
+    @property
+    def accuracy(self):
+        """
+        Accuracy of each alignment, computed as for the individual
+        alignment records (0 for alignments of zero read length).
+        """
+        readLength = self.readLength
+        nErrors = self.nMM.astype(np.int64) + self.nIns + self.nDel
+        accuracy = np.zeros(len(self), dtype=float)
+        nonEmpty = readLength > 0
+        accuracy[nonEmpty] = 1. - nErrors[nonEmpty] / readLength[nonEmpty].astype(float)
+        return accuracy
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long, np.integer)):
+            return self.reader[self.rowNumbers[key]]
+        else:
+            if not isinstance(key, slice):
+                key = np.asarray(key)
+            return AlignmentBatch(self.reader, self.rowNumbers[key])
+
+    def __iter__(self):
+        return (self.reader[rn] for rn in self.rowNumbers)
+
+    def __repr__(self):
+        return "<AlignmentBatch of %d alignments>" % len(self)
+
+
+_COMPARISONS = { "<"  : operator.lt,
+                 "<=" : operator.le,
+                 "==" : operator.eq,
+                 "!=" : operator.ne,
+                 ">=" : operator.ge,
+                 ">"  : operator.gt }
+
+class AlignmentFilter(object):
+    """
+    A declarative filter on alignments, which `readsInRange` applies
+    (via its `filter` argument) to the alignment index columns of the
+    reads in the window, before any alignment object is created.
+
+    `comparisons` is a list of ``(columnName, op, value)`` triples,
+    where `columnName` names an alignment index column (e.g.
+    ``"MapQV"``) or one of the derived columns of `AlignmentBatch`
+    (``"accuracy"``, ``"readLength"``, ``"referenceSpan"``) and `op`
+    is one of ``<``, ``<=``, ``==``, ``!=``, ``>=``, ``>``.
+    Alignments must satisfy all the comparisons, as well as the other
+    criteria given:
+
+      - `strand`: ``"+"`` or ``"-"``
+      - `movieNames`, `readGroups`: the alignment's read group must
+        be among these (given as movie names, or read group IDs)
+      - `minOverlap`: the alignment must overlap the query window by
+        at least this many reference bases
+      - `spanning`: the alignment must span the whole query window
+
+    For example::
+
+        f = AlignmentFilter([("MapQV", ">=", 10), ("accuracy", ">", 0.8)],
+                            strand="+")
+        alns = reader.readsInRange(refId, start, end, filter=f)
+    """
+    def __init__(self, comparisons=(), strand=None, movieNames=None,
+                 readGroups=None, minOverlap=None, spanning=False):
+        for (_, op, _) in comparisons:
+            if op not in _COMPARISONS:
+                raise ValueError, "Bad comparison operator: %s" % op
+        if strand not in (None, "+", "-"):
+            raise ValueError, "Bad `strand` value"
+        self.comparisons = list(comparisons)
+        self.strand      = strand
+        self.movieNames  = movieNames
+        self.readGroups  = readGroups
+        self.minOverlap  = minOverlap
+        self.spanning    = spanning
+
+    def mask(self, batch, refStart, refEnd):
+        """
+        Evaluate the filter on the alignments of an `AlignmentBatch`
+        (for the query window [`refStart`, `refEnd`)), returning a
+        boolean mask of the alignments passing.
+        """
+        mask = np.ones(len(batch), dtype=bool)
+        for (columnName, op, value) in self.comparisons:
+            mask &= _COMPARISONS[op](getattr(batch, columnName), value)
+        if self.strand is not None:
+            mask &= batch.isReverseStrand == (self.strand == "-")
+        if self.readGroups is not None:
+            mask &= np.in1d(batch.ReadGroupID, self.readGroups)
+        if self.movieNames is not None:
+            rgTable = batch.reader.readGroupTable
+            rgIds = rgTable.ID[np.in1d(rgTable.MovieName, self.movieNames)]
+            mask &= np.in1d(batch.ReadGroupID, rgIds)
+        if self.minOverlap is not None:
+            overlap = (np.minimum(batch.tEnd, refEnd).astype(np.int64) -
+                       np.maximum(batch.tStart, refStart))
+            mask &= overlap >= self.minOverlap
+        if self.spanning:
+            mask &= (batch.tStart <= refStart) & (batch.tEnd >= refEnd)
+        return mask
+
+    def apply(self, reader, rowNumbers, refStart, refEnd):
+        """
+        Return those of `rowNumbers` whose alignments pass the filter.
+        """
+        rowNumbers = np.asarray(rowNumbers)
+        return rowNumbers[self.mask(reader.batch(rowNumbers), refStart, refEnd)]
 
 
 class AlignmentRecordMixin(object):
@@ -109,6 +488,8 @@ class AlignmentRecordMixin(object):
     Mixin class providing some higher-level functionality for
     alignment records.
     """
+    __slots__ = []
+
     @property
     def zmw(self):
         if not self.reader.moviesAttached:
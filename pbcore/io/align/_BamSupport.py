@@ -49,8 +49,13 @@ COMPLEMENT_MAP = { "A" : "T",
                    "N" : "N",
                    "-" : "-" }
 
+# Complement of each ASCII code, as a lookup table
+COMPLEMENT_ASCII = np.arange(256, dtype=np.uint8)
+for (_b, _c) in COMPLEMENT_MAP.iteritems():
+    COMPLEMENT_ASCII[ord(_b)] = ord(_c)
+
 def complementAscii(a):
-    return np.array([ord(COMPLEMENT_MAP[chr(b)]) for b in a], dtype=np.int8)
+    return COMPLEMENT_ASCII[np.asarray(a, dtype=np.int8).view(np.uint8)].view(np.int8)
 
 def reverseComplementAscii(a):
     return complementAscii(a)[::-1]
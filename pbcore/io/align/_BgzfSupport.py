@@ -0,0 +1,113 @@
+#################################################################################
+# Copyright (c) 2011-2015, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+# Support for scanning a BAM file in parallel over ranges of records,
+# using the record start offsets recorded in its BAI index to cut the
+# file at record boundaries.
+
+import struct
+from bisect import bisect_left
+from os.path import exists, getsize
+
+# Pseudo-bin holding the per-reference metadata in a BAI index
+_BAI_METADATA_BIN = 37450
+
+
+def _baiRecordOffsets(baiFilename):
+    """
+    The sorted, distinct virtual file offsets of record starts listed
+    in a BAI index: the chunk starts of its bins and the nonzero
+    entries of its linear index.
+    """
+    with open(baiFilename, "rb") as f:
+        data = f.read()
+    if data[:4] != "BAI\1":
+        raise IOError, "Not a BAI index: %s" % baiFilename
+    offsets = set()
+    nReferences = struct.unpack_from("<i", data, 4)[0]
+    i = 8
+    for _ in xrange(nReferences):
+        nBins = struct.unpack_from("<i", data, i)[0]
+        i += 4
+        for _ in xrange(nBins):
+            bin, nChunks = struct.unpack_from("<Ii", data, i)
+            i += 8
+            chunks = struct.unpack_from("<%dQ" % (2 * nChunks), data, i)
+            i += 16 * nChunks
+            if bin != _BAI_METADATA_BIN:
+                offsets.update(chunks[0::2])
+        nIntervals = struct.unpack_from("<i", data, i)[0]
+        i += 4
+        offsets.update(o for o in struct.unpack_from("<%dQ" % nIntervals, data, i)
+                       if o != 0)
+        i += 8 * nIntervals
+    return sorted(offsets)
+
+def splitRecordRanges(bamFilename, nRanges):
+    """
+    Cut the records of `bamFilename` into at most `nRanges` ranges of
+    roughly equal compressed size, returned as a list of ``(begin,
+    end)`` virtual file offsets of record starts; a `begin` of None
+    stands for the first record, an `end` of None for the end of the
+    file.
+
+    The cut points are record starts taken from the BAI index
+    (`bamFilename` + ".bai"); without one the file is a single range.
+    """
+    baiFilename = bamFilename + ".bai"
+    if nRanges <= 1 or not exists(baiFilename):
+        return [ (None, None) ]
+    offsets = _baiRecordOffsets(baiFilename)
+    blockOffsets = [ o >> 16 for o in offsets ]
+    fileSize = getsize(bamFilename)
+    cuts = []
+    for k in xrange(1, nRanges):
+        j = bisect_left(blockOffsets, (fileSize * k) // nRanges)
+        if j < len(offsets) and (not cuts or offsets[j] > cuts[-1]):
+            cuts.append(offsets[j])
+    bounds = [ None ] + cuts + [ None ]
+    return zip(bounds[:-1], bounds[1:])
+
+def recordsInRange(bam, begin, end):
+    """
+    Generate ``(virtualFileOffset, read)`` for the records of the open
+    `Samfile` `bam` starting at or after the virtual file offset
+    `begin` and before `end`, as given by `splitRecordRanges`.
+    """
+    if begin is not None:
+        bam.seek(begin)
+    offset = bam.tell()
+    while end is None or offset < end:
+        try:
+            read = next(bam)
+        except StopIteration:
+            return
+        yield offset, read
+        offset = bam.tell()
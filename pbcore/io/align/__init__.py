@@ -32,3 +32,6 @@ from CmpH5IO      import *
 from BamIO        import *
 from BamAlignment import *
 from BlasrIO      import *
+from CmpH5ToBam   import *
+from PacBioBamIndexBuilder import *
+from _AlignmentMixin import AlignmentBatch, AlignmentFilter
@@ -38,13 +38,16 @@ __all__ = [ "openAlignmentFile",
 from pbcore.io import (FastaTable, FastaReader,
                        BaxH5Reader, BasH5Reader, BasH5Collection,
                        CmpH5Reader, BamReader, IndexedBamReader,
-                       GffReader, FastqReader)
+                       GffReader, FastqReader, buildPacBioBamIndex)
+from os.path import exists
 
-def openIndexedAlignmentFile(fname, referenceFasta=None):
+def openIndexedAlignmentFile(fname, referenceFasta=None, buildIndex=False):
     """
     Factory function to get a handle to a reader for an alignment file
     (cmp.h5 or BAM), requiring index capability (built-in for cmp.h5;
-    requires bam.pbi index for BAM
+    requires bam.pbi index for BAM).  With ``buildIndex=True``, a
+    missing bam.pbi is first written next to the BAM file (see
+    `buildPacBioBamIndex`); otherwise a missing index is an error.
 
     The reference FASTA, if provided, must have a FASTA index
     (fasta.fai).
@@ -52,6 +55,8 @@ def openIndexedAlignmentFile(fname, referenceFasta=None):
     if fname.endswith("cmp.h5"):
         return CmpH5Reader(fname)
     elif fname.endswith("bam"):
+        if buildIndex and not exists(fname + ".pbi"):
+            buildPacBioBamIndex(fname)
         return IndexedBamReader(fname, referenceFasta)
     else:
         raise ValueError, "Invalid alignment file suffix"
@@ -29,6 +29,7 @@
 #################################################################################
 
 import h5py as h
+import os
 import numpy as n
 import bisect
 
@@ -113,21 +114,36 @@ def projectIntoRange(tStart, tEnd, winStart, winEnd):
     or smaller range
     """
     assert(len(tStart) == len(tEnd))
-    res = n.zeros(shape=winEnd-winStart, dtype=n.uint)
+    winLen = winEnd - winStart
     # Clip to window and translate.
     # Be careful to avoid underflow!
-    tStart_ = n.clip(tStart, winStart, winEnd) - winStart
-    tEnd_   = n.clip(tEnd,   winStart, winEnd) - winStart
-    for (s, e) in zip(tStart_, tEnd_):
-        res[s:e] += 1
-    return res
+    tStart_ = (n.clip(tStart, winStart, winEnd) - winStart).astype(n.intp)
+    tEnd_   = (n.clip(tEnd,   winStart, winEnd) - winStart).astype(n.intp)
+    # Difference array: each read contributes +1 where it enters the
+    # window and -1 where it leaves; coverage is the running sum.
+    delta = (n.bincount(tStart_, minlength=winLen + 1) -
+             n.bincount(tEnd_,   minlength=winLen + 1))
+    return n.cumsum(delta[:winLen]).astype(n.uint)
 
 def makeReadLocator(cmpH5, refSeq):
     """
     Return a function which can be called iteratively to find reads
-    quickly.
+    quickly.  If the cmp.h5 file is not sorted, the function searches
+    a virtual sort order of the contig's alignments (see
+    `readLocatorColumns`).
     """
-    if not cmpH5.isSorted: raise Exception, "CmpH5 is not sorted"
+    if not cmpH5.isSorted:
+        rowNumbers = n.flatnonzero(cmpH5.RefGroupID == refSeq).astype(n.uint32)
+        locate = makeReadLocatorFromColumns(
+            *readLocatorColumns(rowNumbers, cmpH5.tStart[rowNumbers], cmpH5.tEnd[rowNumbers]))
+        def g(rangeStart, rangeEnd, justIndices = False):
+            idxs = locate(rangeStart, rangeEnd)
+            if justIndices:
+                return(idxs)
+            else:
+                return(cmpH5.alignmentIndex[idxs,])
+        return g
+
     offsets = cmpH5.file["/RefGroup/OffsetTable"].value
     offStart, offEnd = offsets[offsets[:,0] == refSeq, 1:3].ravel()
 
@@ -155,15 +171,118 @@ def makeReadLocator(cmpH5, refSeq):
             return(refAlignIdx[idxs,])
     return f
 
+# Per-contig arrays backing a read locator, sorted by tStart
+READ_LOCATOR_COLUMNS = ["RowNumber", "tStart", "tEnd", "nBackRead", "nReadOverlap"]
+
+def readLocatorColumns(rowNumbers, tStart, tEnd):
+    """
+    Compute the READ_LOCATOR_COLUMNS arrays for the alignments of one
+    contig, given in any order by their `rowNumbers` and extents.
+    The alignments are put in a virtual sort order by tStart, and
+    `nBackRead` and `nReadOverlap` are computed as in a sorted cmp.h5
+    file: for each alignment i, the number of rows back to the first
+    alignment overlapping tStart[i], and the number of preceding
+    alignments overlapping tStart[i].
+    """
+    order = n.argsort(tStart, kind="mergesort")
+    rowNumbers = n.asarray(rowNumbers)[order]
+    tStart = n.asarray(tStart)[order]
+    tEnd   = n.asarray(tEnd)[order]
+    i = n.arange(len(tStart))
+    if len(tStart) == 0:
+        return [ rowNumbers, tStart, tEnd, i, i ]
+    # The first alignment ending beyond tStart[i] is the first at
+    # which the running maximum of tEnd exceeds tStart[i]
+    firstOverlapping = n.searchsorted(n.maximum.accumulate(tEnd), tStart, side="right")
+    nBackRead = n.maximum(i - firstOverlapping, 0)
+    # An alignment ending at or before tStart[i] starts before it;
+    # the preceding alignments not overlapping tStart[i] are those
+    nEndedBefore = n.searchsorted(n.sort(tEnd), tStart, side="right")
+    nReadOverlap = n.maximum(i - nEndedBefore, 0)
+    return [ rowNumbers, tStart, tEnd, nBackRead, nReadOverlap ]
+
+def makeReadLocatorFromColumns(rowNumbers, tStart, tEnd, nBackRead, nReadOverlap):
+    """
+    Return a read locator function, like those of makeReadLocator,
+    for the alignments of one contig as given by the arrays in
+    READ_LOCATOR_COLUMNS.  The locator returns row numbers.
+    """
+    def f(rangeStart, rangeEnd, justIndices = True):
+        if len(tStart) == 0:
+            return rowNumbers[:0]
+        idxs = getOverlappingRanges(tStart, tEnd, nBackRead, nReadOverlap,
+                                    rangeStart, rangeEnd)
+        return rowNumbers[idxs]
+    return f
+
+def _sourceFileSignature(sourceFilename):
+    st = os.stat(sourceFilename)
+    return st.st_size, st.st_mtime
+
+def writeReadLocatorCache(filename, sourceFilename, numAlignments, readLocatorColumns):
+    """
+    Write a read locator cache: an HDF5 file holding, for each contig,
+    the READ_LOCATOR_COLUMNS arrays backing its read locator, so that
+    they need not be recomputed when the alignment file is reopened.
+    `readLocatorColumns` is an iterable of ``(refId, columns)``
+    pairs.  The size and modification time of `sourceFilename` (the
+    file the locators were computed from) and `numAlignments` (the
+    number of alignments in it) are recorded to detect stale caches.
+    """
+    sourceSize, sourceMTime = _sourceFileSignature(sourceFilename)
+    f = h.File(filename, "w")
+    try:
+        g = f.create_group("ReadLocators")
+        g.attrs["NumAlignments"] = numAlignments
+        g.attrs["SourceSize"]    = sourceSize
+        g.attrs["SourceMTime"]   = sourceMTime
+        for refId, columns in readLocatorColumns:
+            refGroup = g.create_group(str(refId))
+            for (name, column) in zip(READ_LOCATOR_COLUMNS, columns):
+                refGroup.create_dataset(name, data=column)
+    finally:
+        f.close()
+
+def openReadLocatorCache(filename, sourceFilename, numAlignments):
+    """
+    Open a read locator cache written by writeReadLocatorCache,
+    returning its "ReadLocators" group, or None if the file does not
+    exist or was made for a different source file---one differing
+    from `sourceFilename` in size, modification time or number of
+    alignments.
+    """
+    try:
+        f = h.File(filename, "r")
+    except IOError:
+        return None
+    if "ReadLocators" in f:
+        attrs = f["ReadLocators"].attrs
+        expected = { "NumAlignments" : numAlignments }
+        expected["SourceSize"], expected["SourceMTime"] = \
+            _sourceFileSignature(sourceFilename)
+        if all(name in attrs and attrs[name] == value
+               for (name, value) in expected.iteritems()):
+            return f["ReadLocators"]
+    f.close()
+    return None
+
+def readLocatorColumnsFromCache(cache, refId):
+    """
+    The READ_LOCATOR_COLUMNS arrays for contig `refId` from an open
+    read locator cache, or None if the contig is absent.
+    """
+    key = str(refId)
+    if cache is None or key not in cache:
+        return None
+    return [ cache[key][name][:] for name in READ_LOCATOR_COLUMNS ]
+
 def getReadsInRange(cmpH5, coords, justIndices = False):
     """
     Return an ndarray representing the portion of the reads which
     overlap the range specfied by coords, where coords is a
     three-tuple composed of (refSeqID, rangeStart, rangeEnd).  Here,
-    cmpH5 is an hdf5 object representing a pointer to a sorted cmp.h5
-    file.
+    cmpH5 is a CmpH5Reader; the file need not be sorted.
     """
-    if not cmpH5.isSorted: raise Exception, "CmpH5 is not sorted"
     return makeReadLocator(cmpH5, coords[0])(coords[1], coords[2], justIndices)
 
 def getCoverageInRange(cmpH5, coords, rowNumbers=None):
@@ -172,7 +291,6 @@ def getCoverageInRange(cmpH5, coords, rowNumbers=None):
     element represents the number of reads overlapping that position
     in the cmp.h5 file.
     """
-    if not cmpH5.isSorted: raise Exception, "CmpH5 is not sorted"
     if rowNumbers==None:
         rowNumbers  = getReadsInRange(cmpH5, coords, justIndices=True)
     if (len(rowNumbers))==0:
@@ -180,3 +298,31 @@ def getCoverageInRange(cmpH5, coords, rowNumbers=None):
     else:
         return(projectIntoRange(cmpH5.tStart[rowNumbers], cmpH5.tEnd[rowNumbers], coords[1], coords[2]))
 
+
+def coverageTrack(reader, refKey, binSize):
+    """
+    Return the mean coverage in consecutive bins of `binSize` bases
+    tiling the whole of the reference contig `refKey` (the last bin
+    may be shorter).  `reader` may be any indexed alignment reader
+    (`CmpH5Reader` or `IndexedBamReader`).
+
+    The track is computed in one pass over the contig's alignment
+    extents, in time O(reads log reads + bins), without projecting
+    any alignment base by base.
+    """
+    refLength = reader.referenceInfo(refKey).Length
+    rowNumbers = reader.readsInRange(refKey, 0, refLength, justIndices=True)
+    tStart = n.sort(reader.tStart[rowNumbers].astype(n.int64))
+    tEnd   = n.sort(reader.tEnd[rowNumbers].astype(n.int64))
+    binEdges = n.append(n.arange(0, refLength, binSize), refLength).astype(n.int64)
+
+    def basesLeftOf(sortedPositions, x):
+        # sum over positions p < x of (x - p)
+        k = n.searchsorted(sortedPositions, x)
+        prefixSums = n.append(0, n.cumsum(sortedPositions))
+        return x * k - prefixSums[k]
+
+    # The number of aligned bases to the left of each bin edge x,
+    # i.e. sum over reads of |[tStart, tEnd) & [0, x)|
+    alignedBases = basesLeftOf(tStart, binEdges) - basesLeftOf(tEnd, binEdges)
+    return n.diff(alignedBases) / n.diff(binEdges).astype(float)
@@ -8,14 +8,22 @@ from nose import SkipTest
 import numpy as np
 import bisect
 import h5py
+import os, shutil, tempfile, warnings
 from collections import Counter
 
 from pbcore import data
-from pbcore.io import CmpH5Reader, BamReader, IndexedBamReader
+from pbcore.io import (CmpH5Reader, BamReader, IndexedBamReader, AlignmentFilter,
+                       cmpH5ToBam, buildPacBioBamIndex)
+from pbcore.io.align.PacBioBamIndex import PacBioBamIndex
+from pbcore.io.align._AlignmentMixin import PILEUP_BASES
 from pbcore.util.sequences import reverseComplement as RC
 from pbcore.chemistry import ChemistryLookupError
 
 
+def _readNamesInWindow(reader, window):
+    return sorted(a.readName for a in reader.readsInRange(*window))
+
+
 class _BasicAlnFileReaderTests(object):
     """
     Abstract base class for tests of the basic reader
@@ -30,6 +38,17 @@ class _BasicAlnFileReaderTests(object):
 
     def __init__(self):
         self.f = self.READER_CONSTRUCTOR(*self.CONSTRUCTOR_ARGS)
+        self._cleanups = []
+
+    def addCleanup(self, fn, *args):
+        # As in unittest.TestCase: run `fn(*args)` after the test,
+        # whether or not it passes
+        self._cleanups.append((fn, args))
+
+    def teardown(self):
+        while self._cleanups:
+            fn, args = self._cleanups.pop()
+            fn(*args)
         self.alns = list(self.f)
         self.fwdAln = self.alns[70]
         self.revAln = self.alns[71]
@@ -331,6 +350,95 @@ class _IndexedAlnFileReaderTests(_BasicAlnFileReaderTests):
 
         #specificRead = self.f.readsByName(["m140905_042212_sidney_c100564852550000001823085912221377_s1_X0/2771/8741_8874"])
 
+    def testReadsByNames(self):
+        movieName = "m140905_042212_sidney_c100564852550000001823085912221377_s1_X0"
+        queries = [ movieName + "/2771/8900_9000",
+                    movieName + "/37134",
+                    movieName + "/2771/ccs",
+                    "nonexistentMovie/2771",
+                    movieName + "/2771/8741_8874" ]
+        results = self.f.readsByNames(queries)
+        EQ(len(queries), len(results))
+        EQ([movieName + "/2771/8942_9480"], [r.readName for r in results[0]])
+        EQ(14, len(results[1]))
+        EQ(sorted(r.readStart for r in results[1]), [r.readStart for r in results[1]])
+        EQ([], results[2])
+        EQ([], results[3])
+        EQ([movieName + "/2771/8741_8874"], [r.readName for r in results[4]])
+        for (query, result) in zip(queries, results):
+            EQ([r.readName for r in self.f.readsByName(query)],
+               [r.readName for r in result])
+
+    def testBatch(self):
+        rows = [71, 2, 70, 4]
+        b = self.f.batch(rows)
+        EQ(4, len(b))
+        alns = [ self.alns[rn] for rn in rows ]
+        AEQ([a.tStart for a in alns], b.tStart)
+        AEQ([a.MapQV for a in alns], b.MapQV)
+        AEQ([a.readLength for a in alns], b.readLength)
+        AEQ([a.referenceSpan for a in alns], b.referenceSpan)
+        AEQ([a.isReverseStrand for a in alns], b.isReverseStrand)
+        ASIM([1. - float(a.nMM + a.nIns + a.nDel)/a.readLength for a in alns],
+             b.accuracy)
+        EQ(self.revAln.readName, b[0].readName)
+        reverse = b[b.isReverseStrand]
+        EQ([a.readName for a in alns if a.isReverseStrand],
+           [a.readName for a in reverse])
+        with assert_raises(AttributeError):
+            b.NoSuchColumn
+
+    def testReadsInRangeFilter(self):
+        refStart, refEnd = 980, 2300
+        alns = self.f.readsInRange("lambda_NEB3011", refStart, refEnd)
+        movieName = self.fwdAln.readGroupInfo.MovieName
+        f = AlignmentFilter([("readLength", ">=", 200), ("MapQV", "==", 254)],
+                            strand="-", movieNames=[movieName], minOverlap=100)
+        expected = [ a.readName for a in alns
+                     if a.readLength >= 200 and a.MapQV == 254 and a.isReverseStrand and
+                     min(a.tEnd, refEnd) - max(a.tStart, refStart) >= 100 ]
+        assert 0 < len(expected) < len(alns)
+        EQ(expected, [ a.readName for a in
+                       self.f.readsInRange("lambda_NEB3011", refStart, refEnd, filter=f) ])
+        spanning = AlignmentFilter(spanning=True)
+        EQ([ a.readName for a in alns if a.tStart <= refStart and a.tEnd >= refEnd ],
+           [ a.readName for a in
+             self.f.readsInRange("lambda_NEB3011", refStart, refEnd, filter=spanning) ])
+        with assert_raises(ValueError):
+            AlignmentFilter([("MapQV", "=<", 10)])
+
+    def testParallelMap(self):
+        windows = self.f.referenceWindows(5000)
+        EQ((self.f.referenceInfoTable[0].ID, 0, 5000), windows[0])
+        EQ(48502, windows[-1][2])
+        assert all(refId != -1 for (refId, _, _) in windows)
+        expected = [ _readNamesInWindow(self.f, w) for w in windows ]
+        EQ(expected, list(self.f.parallelMap(_readNamesInWindow, windowSize=5000,
+                                             processes=1)))
+        EQ(expected, list(self.f.parallelMap(_readNamesInWindow, windows,
+                                             processes=2)))
+        EQ(expected, list(self.f.parallelMap(_readNamesInWindow, windows,
+                                             processes=2, maxPending=1)))
+
+    def testPileup(self):
+        refStart, refEnd = 980, 2300
+        p = self.f.pileup("lambda_NEB3011", refStart, refEnd)
+        baseCounts = np.zeros((refEnd - refStart, 6), dtype=int)
+        insertionCounts = np.zeros((refEnd - refStart, 5), dtype=int)
+        for a in self.f.readsInRange("lambda_NEB3011", refStart, refEnd):
+            refPositions = a.referencePositions(orientation="genomic")
+            ref = a.reference(orientation="genomic")
+            read = a.read(orientation="genomic")
+            for (pos, refBase, readBase) in zip(refPositions, ref, read):
+                if refStart <= pos < refEnd:
+                    if refBase == "-":
+                        insertionCounts[pos - refStart, "ACGTN".index(readBase)] += 1
+                    else:
+                        baseCounts[pos - refStart, "ACGTN-".index(readBase)] += 1
+        EQ((refStart, refEnd), (p.refStart, p.refEnd))
+        AEQ(baseCounts, p.baseCounts)
+        AEQ(insertionCounts, p.insertionCounts)
+
 
 
 
@@ -357,6 +465,217 @@ class TestCmpH5(_IndexedAlnFileReaderTests):
         with assert_raises(ChemistryLookupError):
             C[0].sequencingChemistry
 
+    def testPulseFeatureBatch(self):
+        rows = [71, 2, 70, 4, 2]
+        for aligned in (True, False):
+            for orientation in ("native", "genomic"):
+                data, offsets = self.f.pulseFeatureBatch(rows, "DeletionQV",
+                                                         aligned, orientation)
+                EQ(len(rows) + 1, len(offsets))
+                for i, rn in enumerate(rows):
+                    AEQ(self.f[rn].DeletionQV(aligned, orientation),
+                        data[offsets[i]:offsets[i+1]])
+        data, offsets = self.f.pulseFeatureBatch([], "DeletionQV")
+        EQ(0, len(data))
+        AEQ([0], offsets)
+
+    def testDecodeBatch(self):
+        rows = [71, 2, 70, 4, 52]
+        for aligned in (True, False):
+            for orientation in ("native", "genomic"):
+                decoded = self.f.decodeBatch(rows, aligned=aligned,
+                                             orientation=orientation)
+                for i, rn in enumerate(rows):
+                    a = self.f[rn]
+                    def decodedString(name):
+                        data, offsets = decoded[name]
+                        return data[offsets[i]:offsets[i+1]].tostring()
+                    EQ(a.read(aligned, orientation), decodedString("read"))
+                    EQ(a.reference(aligned, orientation), decodedString("reference"))
+                    EQ(a.transcript(orientation), decodedString("transcript"))
+        decoded = self.f.decodeBatch(rows, what=["transcript"], style="exonerate+")
+        EQ(["transcript"], decoded.keys())
+        data, offsets = decoded["transcript"]
+        EQ(self.f[rows[0]].transcript(style="exonerate+"),
+           data[offsets[0]:offsets[1]].tostring())
+
+    def testClipToWindow(self):
+        for (refStart, refEnd) in [(980, 2300), (2208, 2214), (16196, 16198)]:
+            rows = self.f.readsInRange("lambda_NEB3011", refStart, refEnd, justIndices=True)
+            clipped = self.f.clipToWindow(rows, refStart, refEnd)
+            EQ(len(rows), len(clipped))
+            for rn, c in zip(rows, clipped):
+                expected = self.f[rn].clippedTo(refStart, refEnd)
+                EQ([getattr(expected, field) for field in clipped.dtype.names],
+                   list(c))
+        with assert_raises(IndexError):
+            self.f.clipToWindow([0, 52], 16196, 16198)
+
+    def testReadLocatorCache(self):
+        tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpDir)
+        sidecar = os.path.join(tmpDir, "readLocators.h5")
+        self.f.writeReadLocatorCache(sidecar)
+        cached = CmpH5Reader(self.CONSTRUCTOR_ARGS[0], readLocatorCache=sidecar)
+        assert cached._readLocatorCache is not None
+        for wStart in xrange(0, 50000, 5000):
+            AEQ(self.f.readsInRange("lambda_NEB3011", wStart, wStart + 5000, justIndices=True),
+                cached.readsInRange("lambda_NEB3011", wStart, wStart + 5000, justIndices=True))
+        cached.close()
+        # A sidecar made for a different file is ignored
+        other = CmpH5Reader(data.getCmpH5(), readLocatorCache=sidecar)
+        EQ(None, other._readLocatorCache)
+        EQ(2, len(other.readsInRange(1, 0, 1000)))
+        other.close()
+        # ... as is one made for a file (here, a copy of the same file)
+        # modified since
+        copy = os.path.join(tmpDir, "copy.cmp.h5")
+        shutil.copyfile(self.CONSTRUCTOR_ARGS[0], copy)
+        CmpH5Reader(copy).writeReadLocatorCache(sidecar)
+        cached = CmpH5Reader(copy, readLocatorCache=sidecar)
+        assert cached._readLocatorCache is not None
+        cached.close()
+        st = os.stat(copy)
+        os.utime(copy, (st.st_atime, st.st_mtime + 10))
+        stale = CmpH5Reader(copy, readLocatorCache=sidecar)
+        EQ(None, stale._readLocatorCache)
+        stale.close()
+
+    def testChunkCache(self):
+        cached = CmpH5Reader(self.CONSTRUCTOR_ARGS[0], chunkCacheSize=2**20)
+        for aln, cachedAln in zip(self.alns, cached):
+            EQ(aln.read(), cachedAln.read())
+            AEQ(aln.DeletionQV(), cachedAln.DeletionQV())
+        cache = cached.chunkCache
+        EQ(cache.misses, len(cache))
+        assert cache.hits > 0
+        assert cache.size <= cache.capacity
+
+
+    def testLazyIndex(self):
+        lazy = CmpH5Reader(self.CONSTRUCTOR_ARGS[0], lazyIndex=True)
+        EQ(len(self.f), len(lazy))
+        AEQ(self.f.readsInRange("lambda_NEB3011", 980, 2300, justIndices=True),
+            lazy.readsInRange("lambda_NEB3011", 980, 2300, justIndices=True))
+        # The range query reads the contig's rows, not whole columns
+        EQ({}, lazy.alignmentIndex._columns)
+        AEQ(self.f.MapQV, lazy.MapQV)
+        AEQ(self.f.alignmentIndex[5:9], lazy.alignmentIndex[5:9])
+        AEQ(self.f.alignmentIndex[[9, 3, 3]], lazy.alignmentIndex[[9, 3, 3]])
+        EQ(self.f.alignmentIndex[-1], lazy.alignmentIndex[-1])
+        for aln, lazyAln in zip(self.alns, lazy):
+            EQ((aln.tStart, aln.tEnd, aln.HoleNumber),
+               (lazyAln.tStart, lazyAln.tEnd, lazyAln.HoleNumber))
+            EQ(aln.read(), lazyAln.read())
+
+    def testMemoryMappedDatasets(self):
+        # Make a copy of the file with the alignment and pulse data
+        # stored contiguously
+        tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpDir)
+        contiguousFilename = os.path.join(tmpDir, "contiguous.cmp.h5")
+        with h5py.File(self.CONSTRUCTOR_ARGS[0], "r") as src:
+            with h5py.File(contiguousFilename, "w") as dst:
+                for name in src:
+                    src.copy(name, dst)
+                for (key, value) in src.attrs.items():
+                    dst.attrs[key] = value
+                for alnGroupPath in src["/AlnGroup/Path"]:
+                    for (name, ds) in src[alnGroupPath].items():
+                        del dst[alnGroupPath][name]
+                        dst[alnGroupPath].create_dataset(name, data=ds.value)
+        mapped = CmpH5Reader(contiguousFilename)
+        for datasets in mapped._alignmentDataById.values():
+            assert isinstance(datasets["AlnArray"], np.memmap)
+        for aln, mappedAln in zip(self.alns, mapped):
+            alnArray = mappedAln.alignmentArray()
+            assert alnArray.flags.writeable
+            alnArray[:] = 0
+            EQ(aln.read(), mappedAln.read())
+            AEQ(aln.DeletionQV(), mappedAln.DeletionQV())
+        AEQ(self.f.pulseFeatureBatch(range(10), "IPD")[0],
+            mapped.pulseFeatureBatch(range(10), "IPD")[0])
+        mapped.close()
+
+    def testUnsortedReadsInRange(self):
+        # Make an unsorted copy of the file, with the alignment rows
+        # reversed and no offset table
+        tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpDir)
+        unsortedFilename = os.path.join(tmpDir, "unsorted.cmp.h5")
+        with h5py.File(self.CONSTRUCTOR_ARGS[0], "r") as src:
+            with h5py.File(unsortedFilename, "w") as dst:
+                for name in src:
+                    src.copy(name, dst)
+                for (key, value) in src.attrs.items():
+                    dst.attrs[key] = value
+                for name in dst["/AlnInfo"]:
+                    dst["/AlnInfo"][name][...] = src["/AlnInfo"][name].value[::-1]
+                del dst["/RefGroup/OffsetTable"]
+        unsorted = CmpH5Reader(unsortedFilename)
+        EQ(False, unsorted.isSorted)
+        n = len(self.f)
+        for window in [("lambda_NEB3011", 980, 2300), ("lambda_NEB3011", 40000, 41000),
+                       ("lambda_NEB3011", 0, 48502)]:
+            rowNumbers = unsorted.readsInRange(*window, justIndices=True)
+            # Rows are returned in order of tStart
+            assert (np.diff(unsorted.tStart[rowNumbers].astype(int)) >= 0).all()
+            EQ(sorted(self.f.readsInRange(*window, justIndices=True)),
+               sorted(n - 1 - rowNumbers))
+            EQ(_readNamesInWindow(self.f, window), _readNamesInWindow(unsorted, window))
+        unsorted.close()
+
+    def testKineticsMatrix(self):
+        c = CmpH5Reader(data.getCmpH5())
+        refStart, refEnd = 980, 2300
+        km = c.kineticsMatrix(1, refStart, refEnd, strand="-")
+        AEQ(sorted(rn for rn in c.readsInRange(1, refStart, refEnd, justIndices=True)
+                   if c[rn].isReverseStrand),
+            sorted(km.rowNumbers))
+        EQ(set(["IPD", "PulseWidth"]), set(km.features))
+        for i, rn in enumerate(km.rowNumbers):
+            aln = c[rn]
+            expected = np.ma.masked_all(refEnd - refStart, dtype=np.float32)
+            isBase = np.array([ m in "MR" for m in aln.transcript(orientation="genomic") ])
+            refPos = aln.referencePositions(orientation="genomic")
+            ipd = aln.IPD(orientation="genomic") * aln.movieInfo.TimeScale
+            inWindow = isBase & (refPos >= refStart) & (refPos < refEnd)
+            expected[refPos[inWindow] - refStart] = ipd[inWindow]
+            AEQ(expected.mask, km.features["IPD"].mask[i])
+            ASIM(expected.compressed(), km.features["IPD"][i].compressed())
+        c.close()
+
+    def testPileupAmbiguousBases(self):
+        from pbcore.io.align.CmpH5IO import _pileupBaseIndex
+        N = PILEUP_BASES.index("N")
+        # IUPAC M (A or C), S (C or G) and an unused encoding, both strands
+        for encoding in [0b0011, 0b0110, 0b1110]:
+            EQ([N, N], list(_pileupBaseIndex[:, encoding]))
+        EQ([PILEUP_BASES.index("A"), PILEUP_BASES.index("T")],
+           list(_pileupBaseIndex[:, 0b0001]))
+
+    def testCmpH5ToBam(self):
+        tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpDir)
+        bamFilename = os.path.join(tmpDir, "converted.bam")
+        cmpH5ToBam(self.CONSTRUCTOR_ARGS[0], bamFilename, processes=2, chunkSize=30)
+        bam = IndexedBamReader(bamFilename)
+        EQ(len(self.f), len(bam))
+        EQ(len([ ref for ref in self.f.referenceInfoTable if ref.ID != -1 ]),
+           len(bam.referenceInfoTable))
+        order = np.lexsort((self.f.tStart, self.f.RefGroupID))
+        for aln, bamAln in zip(self.f[order], bam):
+            EQ((aln.readName, aln.tStart, aln.tEnd, aln.isReverseStrand),
+               (bamAln.readName, bamAln.tStart, bamAln.tEnd, bamAln.isReverseStrand))
+            EQ(aln.read(), bamAln.read())
+            AEQ(aln.DeletionTag(), bamAln.DeletionTag())
+            # QVs are capped at 93 in BAM
+            AEQ(np.minimum(aln.MergeQV(aligned=False), 93), bamAln.MergeQV(aligned=False))
+            AEQ(aln.referencePositions(), bamAln.referencePositions())
+        for window in [("lambda_NEB3011", 980, 2300), ("lambda_NEB3011", 40000, 41000)]:
+            EQ(_readNamesInWindow(self.f, window), _readNamesInWindow(bam, window))
+        bam.close()
+
 
 class TestBasicBam(_BasicAlnFileReaderTests):
      READER_CONSTRUCTOR = BamReader
@@ -365,3 +684,201 @@ class TestBasicBam(_BasicAlnFileReaderTests):
 class TestIndexedBam(_IndexedAlnFileReaderTests):
     READER_CONSTRUCTOR = IndexedBamReader
     CONSTRUCTOR_ARGS   = (data.getBamAndCmpH5()[0], data.getLambdaFasta())
+
+    def testAtRowNumbers(self):
+        rows = [71, 2, 70, 4, 2, 114, 0]
+        alns = self.f[rows]
+        EQ(rows, [a.rowNumber for a in alns])
+        EQ([self.f.atRowNumber(rn).readName for rn in rows],
+           [a.readName for a in alns])
+        EQ([a.readName for a in self.alns[10:20]],
+           [a.readName for a in self.f[10:20]])
+
+    def testRangeQuery(self):
+        pbi = self.f.pbi
+        for winStart in xrange(0, 48502, 997):
+            for winEnd in [winStart, winStart + 1, winStart + 1000]:
+                expected = np.flatnonzero((pbi.tId == 0) &
+                                          (pbi.tStart < winEnd) &
+                                          (pbi.tEnd > winStart))
+                AEQ(expected, pbi.rangeQuery(0, winStart, winEnd))
+        EQ(0, len(pbi.rangeQuery(1, 0, 1000)))
+
+    def testReadLocatorCache(self):
+        tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpDir)
+        sidecar = os.path.join(tmpDir, "locators.h5")
+        self.f.pbi.writeReadLocatorCache(sidecar)
+        cached = IndexedBamReader(*(self.CONSTRUCTOR_ARGS + (sidecar,)))
+        assert cached.pbi._readLocatorCache is not None
+        for window in [(0, 980, 2300), (0, 40000, 41000)]:
+            AEQ(self.f.readsInRange(*window, justIndices=True),
+                cached.readsInRange(*window, justIndices=True))
+        cached.close()
+        # A sidecar made for an index file modified since is ignored
+        copy = os.path.join(tmpDir, "copy.bam.pbi")
+        shutil.copyfile(self.f.pbi.filename, copy)
+        PacBioBamIndex(copy).writeReadLocatorCache(sidecar)
+        st = os.stat(copy)
+        os.utime(copy, (st.st_atime, st.st_mtime + 10))
+        stale = PacBioBamIndex(copy, sidecar)
+        EQ(None, stale._readLocatorCache)
+        stale.close()
+
+    def testLazyPbiColumns(self):
+        pbi = IndexedBamReader(*self.CONSTRUCTOR_ARGS).pbi
+        EQ({}, pbi._columns)
+        pbi.rangeQuery(0, 980, 2300)
+        EQ(set(["tId", "tStart", "tEnd"]), set(pbi._columns))
+        EQ(115, len(pbi))
+        record = pbi[71]
+        assert isinstance(record, np.record)
+        EQ(self.revAln.tStart, record.tStart)
+        EQ(self.revAln.HoleNumber, record["HoleNumber"])
+        EQ(pbi.columnNames, list(record.dtype.names))
+        # Reading rows does not load the columns
+        EQ(set(["tId", "tStart", "tEnd"]), set(pbi._columns))
+        EQ(record, pbi[70:72][1])
+        EQ(record, list(pbi)[71])
+        EQ(set(["tId", "tStart", "tEnd"]), set(pbi._columns))
+        rows = pbi[[71, 70]]
+        AEQ([self.revAln.tStart, self.fwdAln.tStart], rows.tStart)
+        EQ(pbi.columnNames, list(rows.dtype.names))
+        pbi.close()
+        EQ(None, pbi._file)
+
+    def testReadsByNameMatchesAlignedExtent(self):
+        # Ranges are matched against rStart_rEnd, as in readName, not
+        # against the (wider) qStart_qEnd extent of the subread
+        for aln in self.alns[:20]:
+            EQ([aln.readName],
+               [r.readName for r in self.f.readsByName(aln.readName)
+                if r.readName == aln.readName])
+            beforeAligned = "%s/%d_%d" % (aln.zmwName, aln.rStart - 10, aln.rStart)
+            assert aln.readName not in [r.readName for r in
+                                        self.f.readsByName(beforeAligned)]
+
+    def testLazyBamAlignmentFields(self):
+        aln = self.f[71]
+        assert not hasattr(aln, "__dict__")
+        EQ(None, aln._rStart)
+        EQ((self.f.rStart[71], self.f.rEnd[71]), (aln.rStart, aln.rEnd))
+        EQ(self.f.HoleNumber[71], aln.HoleNumber)
+        EQ(self.f.ReadGroupID[71] & 0xFFFFFFFF, aln.readGroupId & 0xFFFFFFFF)
+        clipped = aln.clippedTo(aln.tStart + 5, aln.tEnd - 5)
+        EQ((aln.tStart + 5, aln.tEnd - 5), (clipped.tStart, clipped.tEnd))
+        EQ(aln.readName.split("/")[:2], clipped.readName.split("/")[:2])
+
+    def testPileupAmbiguousBases(self):
+        from pbcore.io.align.BamIO import _pileupBaseIndex
+        for (base, expected) in [("A", "A"), ("c", "C"), ("t", "T"), ("-", "-"),
+                                 ("R", "N"), ("y", "N"), ("N", "N"), ("*", "N")]:
+            EQ(PILEUP_BASES.index(expected), _pileupBaseIndex[ord(base)])
+
+    def testBuildPacBioBamIndex(self):
+        tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpDir)
+        pbiFilename = os.path.join(tmpDir, "built.bam.pbi")
+        buildPacBioBamIndex(self.f.filename, pbiFilename, processes=2)
+        built = PacBioBamIndex(pbiFilename)
+        EQ(len(self.f.pbi), len(built))
+        for columnName in ["virtualFileOffset", "tId", "tStart", "tEnd",
+                           "isReverseStrand", "MapQV", "HoleNumber",
+                           "rStart", "rEnd", "nM", "nMM", "nIns", "nDel"]:
+            AEQ(self.f.pbi.column(columnName), built.column(columnName))
+        AEQ(self.f.pbi.ReadGroupID & 0xFFFFFFFF, built.ReadGroupID & 0xFFFFFFFF)
+        built.close()
+
+    def testThreadedIteration(self):
+        readNames = [ a.readName for a in self.alns ]
+        for readerClass in [BamReader, IndexedBamReader]:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                f = readerClass(self.f.filename, threads=3)
+            # Either pysam took the threads, or we were told it didn't
+            warned = any("threads" in str(w.message) for w in caught)
+            EQ((1, True) if warned else (3, False), (f._threads, warned))
+            EQ(readNames, [ a.readName for a in f ])
+            f.close()
+        f = IndexedBamReader(self.f.filename, threads=3)
+        EQ(range(len(f)), [ a.rowNumber for a in f ])
+        f.close()
+
+    def testMemoizedDecoding(self):
+        aln = self.f[71]
+        uc = aln.unrolledCigar().copy()
+        assert not aln.unrolledCigar().flags.writeable
+        transcript = aln.transcript()
+        AEQ(uc, aln.unrolledCigar())
+        assert aln.transcript() is transcript
+        read = aln.read()
+        assert aln.read() is read
+        reference = aln.reference()
+        assert aln.reference() is reference
+        fresh = self.f[71]
+        EQ((read, reference, transcript),
+           (fresh.read(), fresh.reference(), fresh.transcript()))
+
+    def testReferenceSequenceBlocks(self):
+        f = IndexedBamReader(self.f.filename, self.f.referenceFasta.filename)
+        f.REFERENCE_BLOCK_SIZE = 1000
+        aln = f[71]
+        fastaSequence = f.referenceFasta[aln.referenceName].sequence
+        for (start, end) in [(aln.tStart, aln.tEnd),
+                             (aln.tStart + 1, aln.tEnd - 1),
+                             (990, 2010),
+                             (len(fastaSequence) - 5, len(fastaSequence)),
+                             (10, 10)]:
+            EQ(fastaSequence[start:end],
+               f.referenceSequence(aln.referenceName, start, end))
+            EQ(RC(fastaSequence[start:end]),
+               f.referenceSequence(aln.referenceName, start, end, True))
+        # Overlapping windows are served from the same cached blocks
+        cachedBlocks = set(f._referenceCache)
+        f.referenceSequence(aln.referenceName, aln.tStart + 2, aln.tEnd - 2)
+        EQ(cachedBlocks, set(f._referenceCache))
+        f.close()
+
+    def testCigarBatch(self):
+        rows = [71, 2, 70, 114]
+        for orientation in ["native", "genomic"]:
+            batch = self.f.cigarBatch(rows, orientation=orientation)
+            EQ(len(rows) + 1, len(batch.offsets))
+            for (i, rn) in enumerate(rows):
+                aln = self.f[rn]
+                s = slice(batch.offsets[i], batch.offsets[i+1])
+                AEQ(aln.unrolledCigar(orientation), batch.ops[s])
+                AEQ(aln.referencePositions(orientation=orientation),
+                    batch.referencePositions[s])
+                AEQ(aln.readPositions(orientation=orientation),
+                    batch.readPositions[s])
+        EQ(1, len(self.f.cigarBatch([]).offsets))
+
+    def testClipToWindow(self):
+        for (refStart, refEnd) in [(980, 2300), (2208, 2214), (16196, 16198)]:
+            rows = self.f.readsInRange("lambda_NEB3011", refStart, refEnd, justIndices=True)
+            clipped = self.f.clipToWindow(rows, refStart, refEnd)
+            EQ(len(rows), len(clipped))
+            for rn, c in zip(rows, clipped):
+                expected = self.f[rn].clippedTo(refStart, refEnd)
+                EQ([getattr(expected, field) for field in clipped.dtype.names],
+                   list(c))
+
+    def testPulseFeatureBatch(self):
+        rows = [71, 2, 70, 4, 2]
+        features = ["read", "QualityValue"] + sorted(self.f.pulseFeaturesAvailable())
+        for aligned in (True, False):
+            for orientation in ("native", "genomic"):
+                batch = self.f.pulseFeatureBatch(rows, features, aligned, orientation)
+                EQ(set(features), set(batch))
+                for featureName in features:
+                    data, offsets = batch[featureName]
+                    EQ(len(rows) + 1, len(offsets))
+                    for i, rn in enumerate(rows):
+                        AEQ(self.f[rn].pulseFeature(featureName, aligned, orientation),
+                            data[offsets[i]:offsets[i+1]])
+        data, offsets = self.f.pulseFeatureBatch(rows, "read", aligned=False)
+        EQ(self.f[71].read(aligned=False), data[offsets[0]:offsets[1]].tostring())
+        data, offsets = self.f.pulseFeatureBatch([], "QualityValue")
+        EQ(0, len(data))
+        AEQ([0], offsets)
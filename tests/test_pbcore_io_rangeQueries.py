@@ -1,5 +1,5 @@
 from nose.tools import assert_equal
-from numpy.testing import assert_array_equal
+from numpy.testing import assert_array_equal, assert_array_almost_equal
 
 import pbcore.io.rangeQueries as RQ
 from pbcore import data
@@ -69,3 +69,24 @@ class TestGetReadsInRange:
             winEnd = winStart + 1
             assert_array_equal([len(brute_force_reads_in_range(winStart, winEnd, self.cmpH5.tStart, self.cmpH5.tEnd))],
                                RQ.getCoverageInRange(self.cmpH5, (1, winStart, winEnd)))
+
+    def test_coverage_track(self):
+        refLength = self.cmpH5.referenceInfo(1).Length
+        for binSize in [1, 1000, 4999, refLength + 1]:
+            track = RQ.coverageTrack(self.cmpH5, 1, binSize)
+            coverage = RQ.getCoverageInRange(self.cmpH5, (1, 0, refLength))
+            expected = [ mean(coverage[s:s+binSize]) for s in xrange(0, refLength, binSize) ]
+            assert_array_almost_equal(expected, track)
+
+    def test_read_locator_columns(self):
+        # A read locator over a shuffled copy of the contig's rows
+        # finds the same reads
+        rowNumbers = random.RandomState(42).permutation(len(self.cmpH5)).astype(uint32)
+        locate = RQ.makeReadLocatorFromColumns(
+            *RQ.readLocatorColumns(rowNumbers,
+                                   self.cmpH5.tStart[rowNumbers],
+                                   self.cmpH5.tEnd[rowNumbers]))
+        for winStart in xrange(0, 45000, 77):
+            winEnd = winStart + 77
+            assert_array_equal(brute_force_reads_in_range(winStart, winEnd, self.cmpH5.tStart, self.cmpH5.tEnd),
+                               sort(locate(winStart, winEnd)))